@@ -1,58 +1,173 @@
+import argparse
+import fileinput
+import itertools
+import json
+import logging
+import multiprocessing
+import sys
+
 import chess
-import win32clipboard
 
-def get_piece_positions(board):
-    piece_positions = {}
-    for square in chess.SQUARES:
-        piece = board.piece_at(square)
-        if piece is not None:
-            piece_color = "white" if piece.color == chess.WHITE else "black"
-            piece_name = piece.symbol().lower()
-            if piece_name not in piece_positions:
-                piece_positions[piece_name] = {}
-            if piece_color not in piece_positions[piece_name]:
-                piece_positions[piece_name][piece_color] = []
-            piece_positions[piece_name][piece_color].append(chess.square_name(square))
-    return piece_positions
-
-win32clipboard.OpenClipboard()
-FEN_str = win32clipboard.GetClipboardData()
-win32clipboard.CloseClipboard()
-
-board = chess.Board(FEN_str)
+from move_annotations import annotate_moves
+
+
+log = logging.getLogger('stockgpt')
 
 abbv_2_piece = {'r': 'Rook(s)', 'n': 'Knight(s)', 'b': 'Bishop(s)', 'q': 'Queen(s)', 'k': 'King', 'p': 'Pawn(s)'}
 colors = ['White', 'Black']
 
 
+def get_piece_positions(board):
+    # [(piece symbol, white squares, black squares)], piece types in the order
+    # they first appear from a1 to h8, read straight off the bitboards
+    present = []
+    for piece_type in chess.PIECE_TYPES:
+        white = board.pieces_mask(piece_type, chess.WHITE)
+        black = board.pieces_mask(piece_type, chess.BLACK)
+        if white | black:
+            present.append((chess.lsb(white | black), piece_type, white, black))
+    present.sort()
+    return [(chess.piece_symbol(piece_type),
+             [chess.square_name(square) for square in chess.scan_forward(white)],
+             [chess.square_name(square) for square in chess.scan_forward(black)])
+            for _, piece_type, white, black in present]
+
+
+def san_moves(board):
+    # Same strings as board.san() for every legal move, but check and mate come
+    # from the bitboard annotations instead of playing each move out
+    annotations = annotate_moves(board)
+    targets = {}
+    for annotation in annotations:
+        if annotation.piece_type not in (chess.PAWN, chess.KING):
+            key = (annotation.piece_type, annotation.move.to_square)
+            targets[key] = targets.get(key, 0) | chess.BB_SQUARES[annotation.move.from_square]
+
+    moves = []
+    for move, piece_type, captured, check, mate in annotations:
+        if piece_type == chess.KING and board.is_castling(move):
+            san = 'O-O' if chess.square_file(move.to_square) > chess.square_file(move.from_square) else 'O-O-O'
+        else:
+            san = ''
+            if piece_type == chess.PAWN:
+                if captured:
+                    san = chess.FILE_NAMES[chess.square_file(move.from_square)]
+            else:
+                san = chess.piece_symbol(piece_type).upper()
+                others = targets.get((piece_type, move.to_square), 0) & ~chess.BB_SQUARES[move.from_square]
+                if others:
+                    if others & chess.BB_FILES[chess.square_file(move.from_square)]:
+                        if others & chess.BB_RANKS[chess.square_rank(move.from_square)]:
+                            san += chess.FILE_NAMES[chess.square_file(move.from_square)]
+                        san += chess.RANK_NAMES[chess.square_rank(move.from_square)]
+                    else:
+                        san += chess.FILE_NAMES[chess.square_file(move.from_square)]
+            if captured:
+                san += 'x'
+            san += chess.square_name(move.to_square)
+            if move.promotion:
+                san += '=' + chess.piece_symbol(move.promotion).upper()
+        if mate:
+            san += '#'
+        elif check:
+            san += '+'
+        moves.append(san)
+    return moves
+
+
 def get_game_state(board):
-    game_state = ""
     piece_positions = get_piece_positions(board)
-    game_state += "GAME STATE\n"
-    for color in colors:
-        for piece in piece_positions:
-            output = f"{color} {abbv_2_piece[piece]}: "
-            if color.lower() in piece_positions[piece]:
-                output += ', '.join(piece_positions[piece][color.lower()])
-            game_state += output + "\n"
-        game_state += "\n"
-
+    game_state = ["GAME STATE\n"]
+    for color_index, color in enumerate(colors):
+        for piece, *squares in piece_positions:
+            game_state.append(f"{color} {abbv_2_piece[piece]}: {', '.join(squares[color_index])}\n")
+        game_state.append("\n")
 
     if board.turn == chess.WHITE:
-        game_state += "White's Turn!\n"
+        game_state.append("White's Turn!\n")
     else:
-        game_state += "Black's Turn!\n"
+        game_state.append("Black's Turn!\n")
+
+    legal_moves = san_moves(board)
+    game_state.append("LEGAL MOVES\n" + ', '.join(legal_moves))
+    return ''.join(game_state)
+
+
+def get_game_record(board):
+    return {
+        'fen': board.fen(),
+        'turn': 'white' if board.turn == chess.WHITE else 'black',
+        'pieces': {color.lower(): {chess.piece_name(chess.PIECE_SYMBOLS.index(piece)): squares[color_index]
+                                   for piece, *squares in get_piece_positions(board) if squares[color_index]}
+                   for color_index, color in enumerate(colors)},
+        'legal_moves': san_moves(board),
+    }
+
+
+def convert(line, as_json=False):
+    # Returns the formatted record and an error message, one of them None
+    fen = line.strip()
+    try:
+        board = chess.Board(fen)
+    except ValueError as e:
+        if as_json:
+            return json.dumps({'fen': fen, 'error': str(e)}), str(e)
+        return None, str(e)
+    if as_json:
+        return json.dumps(get_game_record(board)), None
+    return get_game_state(board) + '\n', None
+
+
+def convert_json(line):
+    return convert(line, as_json=True)
+
+
+def iter_fens(paths):
+    # fileinput reads stdin for '-' or no paths, one line at a time
+    with fileinput.input(paths or ['-'], encoding='utf-8') as lines:
+        for line in lines:
+            if line.strip() and not line.startswith('#'):
+                yield line
+
+
+def convert_stream(lines, as_json=False, processes=1, batch_size=10000):
+    # Yields (record, error) in input order, at most one batch is held in memory
+    worker = convert_json if as_json else convert
+    if processes <= 1:
+        for line in lines:
+            yield worker(line)
+        return
+    lines = iter(lines)
+    with multiprocessing.Pool(processes) as pool:
+        while True:
+            # imap consumes its iterable eagerly, so it only ever sees one batch
+            batch = list(itertools.islice(lines, batch_size))
+            if not batch:
+                return
+            yield from pool.imap(worker, batch, chunksize=max(1, len(batch) // (4 * processes)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the game state and legal moves for FEN strings, one per line.')
+    parser.add_argument('paths', nargs='*', help='files to read, stdin when empty or -')
+    parser.add_argument('--json', action='store_true', help='write one JSON object per line instead of text blocks')
+    parser.add_argument('-j', '--processes', type=int, default=1, help='worker processes, 0 for one per CPU')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
 
-    legal_moves = [board.san(move) for move in board.legal_moves]
-    game_state += "LEGAL MOVES\n" + ', '.join(legal_moves)
+    processes = args.processes or multiprocessing.cpu_count()
+    out = sys.stdout
+    errors = 0
+    for record, error in convert_stream(iter_fens(args.paths), args.json, processes, args.batch_size):
+        if error is not None:
+            errors += 1
+            log.warning('Skipping invalid FEN: %s', error)
+        if record is not None:
+            out.write(record + '\n')
+    out.flush()
+    return 1 if errors else 0
 
-    win32clipboard.OpenClipboard()
-    win32clipboard.EmptyClipboard()
-    win32clipboard.SetClipboardText(game_state)
-    win32clipboard.CloseClipboard()
-    print(game_state)
 
-get_game_state(board)
-move = input("Insert proposed move")
-board.push_san(move)
-get_game_state(board)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from config import GPT_BASE_URL, GPT_HEADERS, LICHESS_BASE_URL, LICHESS_HEADERS, METRICS_PATH
+from chess_client import ChessClient
+from gpt_client import GPTAgent, find_answer, sse_chunk
+from response_cache import ResponseCache
+from scheduler import DeadlineExceeded
+from game_sessions import GameSessions
+from game_store import GameStore
+from transport import RETRY_STATUSES, transport
+from metrics import log, tracer
+
+
+class LoopGPTAgent(GPTAgent):
+    # compute_next_move stays synchronous and runs in a worker thread, the
+    # completion round trip itself is handed back to the event loop.
+    def __init__(self, engine, role='proposer', cache=None, base_url=GPT_BASE_URL, stream=False, model='gpt-4'):
+        super().__init__(role=role, cache=cache, base_url=base_url, stream=stream, model=model)
+        self.engine = engine
+
+    def post_completion(self, body, deadline=None):
+        return self.wait(self.engine.post_completion(self.base_url, body, deadline), deadline)
+
+    def stream_completion(self, body, marker, deadline=None):
+        return self.wait(self.engine.stream_completion(self.base_url, body, marker, deadline), deadline)
+
+    def wait(self, coro, deadline):
+        future = asyncio.run_coroutine_threadsafe(coro, self.engine.loop)
+        try:
+            return future.result(timeout=None if deadline is None else deadline.remaining())
+        except concurrent.futures.TimeoutError:
+            # Cancels the task on the loop, which closes the connection
+            future.cancel()
+            raise DeadlineExceeded('completion cut off by the move budget')
+
+
+class AsyncChessEngine:
+    def __init__(self, max_games=4, base_url=LICHESS_BASE_URL, gpt_base_url=GPT_BASE_URL, cache=None, ponder=False, fan_out=0, deadline=30.0, book=None, stream=False, tactics=False, route=False, light_model=None):
+        self.max_games = max_games
+        self.route = route
+        self.light_model = light_model
+        self.tactics = tactics
+        self.book = book
+        self.stream = stream
+        self.ponder = ponder
+        self.fan_out = fan_out
+        self.deadline = deadline
+        self.base_url = base_url
+        self.gpt_base_url = gpt_base_url
+        self.cache = cache if cache is not None else ResponseCache()
+        self.sessions = GameSessions()
+        self.store = GameStore()
+        self.active = set()
+        self.executor = ThreadPoolExecutor(max_workers=max_games)
+        self.loop = None
+        self.session = None
+        self.slots = None
+        self.results = {}
+
+    async def __aenter__(self):
+        self.loop = asyncio.get_running_loop()
+        self.session = aiohttp.ClientSession()
+        self.slots = asyncio.Semaphore(self.max_games)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        self.executor.shutdown(wait=False)
+
+    def make_client(self, game_id, color, fen=None):
+        client = ChessClient(fen=fen, cache=self.cache, sessions=self.sessions, store=self.store, base_url=self.base_url, ponder=self.ponder, fan_out=self.fan_out, deadline=self.deadline, book=self.book, tactics=self.tactics, route=self.route)
+        if self.light_model is not None and client.router is not None:
+            client.router.light_model = self.light_model
+        client.game_id = game_id
+        client.color = color
+        client.agent = LoopGPTAgent(self, role='proposer', cache=self.cache, base_url=self.gpt_base_url, stream=self.stream)
+        client.critic_agent = LoopGPTAgent(self, role='critic', cache=self.cache, base_url=self.gpt_base_url, stream=self.stream)
+        if client.router is not None:
+            client.light_agent = LoopGPTAgent(self, role='proposer', cache=self.cache, base_url=self.gpt_base_url, stream=self.stream, model=client.router.light_model)
+        for agent in (client.agent, client.critic_agent, client.light_agent):
+            if agent is not None:
+                agent.on_latency = client.scheduler.record_query
+        return client
+
+    async def request(self, method, url, deadline=None, **kwargs):
+        # Transport.request on the event loop: connection errors, 429 and 5xx are
+        # retried after Retry-After or a jittered backoff. The caller releases the
+        # response, e.g. with async with.
+        for attempt in range(transport.retries + 1):
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded(f'{method} {url} cut off by the move budget')
+            try:
+                resp = await self.session.request(method, url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                wait = transport.retry_wait(attempt, deadline=deadline)
+                if wait is None:
+                    if attempt == transport.retries:
+                        raise
+                    raise DeadlineExceeded(f'{method} {url} failed with no time left to retry') from e
+                log.warning('%s %s failed (%r), retrying in %.1fs', method, url, e, wait)
+                await asyncio.sleep(wait)
+                continue
+
+            if resp.status not in RETRY_STATUSES:
+                return resp
+            wait = transport.retry_wait(attempt, resp, deadline)
+            if wait is None:
+                # Out of attempts, or waiting would only flag us: hand back the error response
+                return resp
+            log.warning('%s %s returned %d, retrying in %.1fs', method, url, resp.status, wait)
+            resp.release()
+            await asyncio.sleep(wait)
+
+    async def post_completion(self, base_url, body, deadline=None):
+        async with await self.request('POST', f'{base_url}/v1/chat/completions', deadline, headers=GPT_HEADERS, json=body) as r:
+            return await r.json(content_type=None)
+
+    async def stream_completion(self, base_url, body, marker, deadline=None):
+        text = ''
+        async with await self.request('POST', f'{base_url}/v1/chat/completions', deadline, headers=GPT_HEADERS, json=body) as r:
+            async for content in self.iter_sse(r):
+                text += content
+        return text, find_answer(text, marker)
+
+    async def iter_sse(self, resp):
+        # Stops with the message, leaving the block releases the connection
+        async for line in resp.content:
+            text, finished = sse_chunk(line)
+            if text:
+                yield text
+            if finished:
+                return
+
+    async def make_move(self, game_id, uci_string, deadline=None):
+        # True once Lichess has taken the move. deadline is our clock running
+        # out, retries that would outlast it give up.
+        try:
+            resp = await self.request('POST', f'{self.base_url}/api/bot/game/{game_id}/move/{uci_string}', deadline, headers=LICHESS_HEADERS)
+        except DeadlineExceeded as e:
+            log.error('Move %s in game %s not sent in time: %r', uci_string, game_id, e)
+            return False
+        async with resp as r:
+            if r.status >= 400:
+                log.error('Move %s in game %s failed with %d: %s', uci_string, game_id, r.status, await r.text())
+                return False
+            await r.read()
+            return True
+
+    async def iter_ndjson(self, resp):
+        async for line in resp.content:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    async def start_challenge(self, username, fen=None):
+        challenge_body = {
+            'keepAliveStream': True,
+            'color': 'black',
+            'level': 2,
+        }
+        if fen != None:
+            challenge_body['fen'] = fen
+        game_id = None
+        color = None
+        async with await self.request('POST', f'{self.base_url}/api/challenge/{username}', headers=LICHESS_HEADERS, json=challenge_body) as resp:
+            async for json_resp in self.iter_ndjson(resp):
+                if 'challenge' in json_resp:
+                    game_id = json_resp['challenge']['id']
+                    color = json_resp['challenge']['color']
+                if 'done' in json_resp and json_resp['done'] != 'accepted':
+                    raise Exception('Game was not properly accepted')
+                if username == 'ai' and 'id' in json_resp:
+                    game_id = json_resp['id']
+                    color = 'black'
+                    break
+        return game_id, color
+
+    async def run_game(self, game_id, color, fen=None):
+        client = self.make_client(game_id, color, fen)
+        self.sessions.add(game_id, color, fen)
+        self.store.start_game(game_id, color, client.initial_fen)
+        status = None
+        failures = 0
+        while status is None:
+            try:
+                status = await self.stream_game(client)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.warning('Game stream for %s dropped: %r', game_id, e)
+            if status is None:
+                failures = 1 if client.stream_events else failures + 1
+                wait = transport.delay(min(failures - 1, 10))
+                log.info('Reconnecting to game %s in %.1fs', game_id, wait)
+                await asyncio.sleep(wait)
+        if client.ponderer is not None:
+            client.ponderer.shutdown()
+        client.close_pool()
+        if client.router is not None:
+            log.info('Routing for %s: %s', game_id, client.router.stats())
+        self.store.finish_game(game_id, client.color, status, client.winner)
+        self.sessions.remove(game_id)
+        self.results[game_id] = status
+        log.info('Game %s finished: %s', game_id, status)
+        return status
+
+    async def stream_game(self, client):
+        # Returns the final status, or None if the connection drops before the game ends
+        client.stream_events = 0
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+        async with await self.request('GET', f'{self.base_url}/api/bot/game/stream/{client.game_id}', headers=LICHESS_HEADERS, timeout=timeout) as resp:
+            if resp.status >= 400:
+                log.error('Cannot stream game %s: %d %s', client.game_id, resp.status, await resp.text())
+                return f'http {resp.status}'
+            async for json_resp in self.iter_ndjson(resp):
+                client.stream_events += 1
+                if json_resp.get('type') == 'gameFull':
+                    json_resp = client.on_game_full(json_resp)
+                if json_resp.get('type') != 'gameState':
+                    continue
+                if json_resp['status'] != 'started':
+                    client.winner = json_resp.get('winner')
+                    return json_resp['status']
+
+                flag = client.scheduler.flag_deadline(json_resp, client.color)
+                bot_move = await self.loop.run_in_executor(self.executor, client.on_game_state, json_resp)
+                if bot_move is None:
+                    continue
+                sent = time.perf_counter()
+                accepted = await self.make_move(client.game_id, bot_move, flag)
+                tracer.record('make_move', (time.perf_counter() - sent) * 1000, game=client.game_id, move=bot_move)
+                if not accepted:
+                    # No event follows a move Lichess refused, reconnect and play from its gameFull
+                    client.last_decision = None
+                    return None
+                client.push_bot_move(bot_move)
+        return None
+
+    async def play_game(self, game_id, color, fen=None):
+        # The event stream announces ongoing games again on connect, play each one only once
+        if game_id in self.active:
+            return None
+        self.active.add(game_id)
+        try:
+            async with self.slots:
+                return await self.run_game(game_id, color, fen)
+        finally:
+            self.active.discard(game_id)
+
+    def resume_games(self):
+        tasks = []
+        for game_id, game in self.sessions.games().items():
+            log.info('Resuming game %s', game_id)
+            tasks.append(asyncio.create_task(self.play_game(game_id, game['color'], game['fen'])))
+        return tasks
+
+    async def challenge_and_play(self, username, fen=None):
+        # Hold the slot from the challenge onwards so we never have more open games than the cap
+        async with self.slots:
+            game_id, color = await self.start_challenge(username, fen)
+            self.active.add(game_id)
+            try:
+                return await self.run_game(game_id, color, fen)
+            finally:
+                self.active.discard(game_id)
+
+    async def play_challenges(self, username, count, fen=None):
+        tasks = [asyncio.create_task(self.challenge_and_play(username, fen)) for _ in range(count)]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def listen(self):
+        # Accept every game Lichess starts for us, at most max_games at a time
+        tasks = set()
+        async with self.session.get(f'{self.base_url}/api/stream/event', headers=LICHESS_HEADERS, timeout=aiohttp.ClientTimeout(total=None)) as resp:
+            async for event in self.iter_ndjson(resp):
+                if event.get('type') != 'gameStart':
+                    continue
+                game = event['game']
+                task = asyncio.create_task(self.play_game(game.get('gameId', game.get('id')), game.get('color'), game.get('fen')))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main(args):
+    async with AsyncChessEngine(max_games=args.concurrency, base_url=args.lichess_url, gpt_base_url=args.gpt_url, ponder=args.ponder, fan_out=args.fan_out, deadline=args.deadline, book=args.book, stream=args.stream, tactics=args.tactics, route=args.route, light_model=args.light_model) as engine:
+        resumed = engine.resume_games()
+        if args.listen:
+            await engine.listen()
+        else:
+            for result in await engine.play_challenges(args.opponent, args.games):
+                if isinstance(result, Exception):
+                    log.error('Game failed: %r', result)
+        for result in await asyncio.gather(*resumed, return_exceptions=True):
+            if isinstance(result, Exception):
+                log.error('Resumed game failed: %r', result)
+    log.info('GPT cache: %s', engine.cache.stats())
+    engine.cache.close()
+    engine.store.close()
+    log.info('Game records: %s', engine.store.stats())
+    tracer.flush()
+    tracer.write_prometheus(METRICS_PATH)
+    log.info('Latency: %s', tracer.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play several Lichess games concurrently on one event loop.')
+    parser.add_argument('--games', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--opponent', default='ai')
+    parser.add_argument('--listen', action='store_true', help='play incoming games from the event stream instead of challenging')
+    parser.add_argument('--ponder', action='store_true', help='precompute replies to likely opponent moves')
+    parser.add_argument('--fan-out', type=int, default=0, help='parallel proposer samples per move (0 for the sequential rounds)')
+    parser.add_argument('--deadline', type=float, default=30.0, help='seconds allowed per move in parallel mode')
+    parser.add_argument('--book', default=None, help='Polyglot opening book to play from during the opening')
+    parser.add_argument('--stream', action='store_true', help='stream completions, cut off when the move deadline passes')
+    parser.add_argument('--tactics', action='store_true', help='play forced tactics and veto blunders with a local search')
+    parser.add_argument('--route', action='store_true', help='play trivial positions instantly and send simple ones to a cheaper model')
+    parser.add_argument('--light-model', default=None, help='model for simple positions when routing (default gpt-3.5-turbo)')
+    parser.add_argument('--lichess-url', default=LICHESS_BASE_URL)
+    parser.add_argument('--gpt-url', default=GPT_BASE_URL)
+    parser.add_argument('--log-level', default='INFO', help='DEBUG also dumps every prompt and response')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+    asyncio.run(main(args))
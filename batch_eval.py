@@ -0,0 +1,332 @@
+import argparse
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import chess
+import chess.pgn
+
+from config import GPT_BASE_URL
+from chess_client import ChessClient
+from gpt_client import GPTAgent, find_answer
+from response_cache import ResponseCache
+from scheduler import Deadline
+from transport import Transport
+from metrics import log, percentile
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# fen is the position before last_move when there is one, so the prompt can say what the opponent captured
+Position = namedtuple('Position', ['source', 'index', 'fen', 'last_move', 'reference'])
+
+COLUMNS = ['source', 'index', 'fen', 'phase', 'tokens', 'static_tokens', 'legal_moves', 'reference',
+           'move', 'legal', 'correct', 'latency_ms', 'feature_ms', 'error', 'response']
+
+
+def iter_pgn(path, min_ply=0, max_ply=None, every=1):
+    # One game in memory at a time, every position is scored against the move actually played
+    with open(path, encoding='utf-8', errors='replace') as handle:
+        for game_number in itertools.count():
+            game = chess.pgn.read_game(handle)
+            if game is None:
+                return
+            if game.headers.get('Variant', 'Standard') != 'Standard':
+                continue
+            board = game.board()
+            last_move = None
+            before = None
+            for ply, move in enumerate(game.mainline_moves()):
+                if max_ply is not None and ply >= max_ply:
+                    break
+                if ply >= min_ply and (ply - min_ply) % every == 0:
+                    if last_move is None:
+                        yield Position(path, f'{game_number}:{ply}', board.fen(), None, move.uci())
+                    else:
+                        yield Position(path, f'{game_number}:{ply}', before, last_move.uci(), move.uci())
+                before = board.fen()
+                last_move = move
+                board.push(move)
+
+
+def iter_fen(path):
+    # One position per line: a FEN optionally followed by reference moves in UCI,
+    # or an EPD record whose bm operation holds the reference moves
+    with open(path, encoding='utf-8') as handle:
+        for line_number, line in enumerate(handle):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit():
+                board = chess.Board(' '.join(fields[:6]))
+                reference = ' '.join(fields[6:])
+                index = str(line_number)
+            else:
+                board, ops = chess.Board.from_epd(line)
+                reference = ' '.join(move.uci() for move in ops.get('bm', []))
+                index = str(ops.get('id', line_number))
+            yield Position(path, index, board.fen(), None, reference)
+
+
+def iter_positions(paths, min_ply=0, max_ply=None, every=1):
+    for path in paths:
+        if path.endswith('.pgn'):
+            yield from iter_pgn(path, min_ply, max_ply, every)
+        else:
+            yield from iter_fen(path)
+
+
+_client = None
+
+
+def _init_worker():
+    global _client
+    # Only the prompt building half of the client is used, keep the cache in memory
+    _client = ChessClient(cache=ResponseCache(path=None))
+
+
+def featurize(position):
+    start = time.perf_counter()
+    board = chess.Board(position.fen)
+    captured = None
+    if position.last_move is not None:
+        move = chess.Move.from_uci(position.last_move)
+        _client.board = board
+        captured = _client.move_capture(move)
+        board.push(move)
+    if board.is_game_over():
+        return None
+    _client.board = board
+    _client.color = 'white' if board.turn == chess.WHITE else 'black'
+    phase = _client.get_game_status()
+    span = {}
+    prompt = _client.build_prompt(phase, position.last_move or '', captured, span=span)
+    return {
+        'source': position.source,
+        'index': position.index,
+        'fen': board.fen(),
+        'phase': phase,
+        'prompt': prompt,
+        'tokens': span['tokens'],
+        'static_tokens': span['static_tokens'],
+        'legal_moves': board.legal_moves.count(),
+        'reference': position.reference,
+        'feature_ms': round((time.perf_counter() - start) * 1000, 3),
+    }
+
+
+class Dispatcher:
+    # Keeps at most `concurrency` proposer queries in flight, so a slow endpoint
+    # holds back the reader instead of piling up prompts in memory.
+    def __init__(self, agent, concurrency=32, timeout=None):
+        self.agent = agent
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.pending = set()
+
+    def submit(self, features):
+        self.pending.add(self.executor.submit(self.evaluate, features))
+        if len(self.pending) >= self.concurrency:
+            return self.collect(FIRST_COMPLETED)
+        return []
+
+    def collect(self, return_when=ALL_COMPLETED):
+        done, self.pending = wait(self.pending, return_when=return_when)
+        return [future.result() for future in done]
+
+    def evaluate(self, features):
+        board = chess.Board(features['fen'])
+        deadline = Deadline(self.timeout) if self.timeout else None
+        response = ''
+        error = ''
+        start = time.perf_counter()
+        try:
+            response = self.agent.query(features['prompt'], board, features['phase'], marker='UCI', deadline=deadline)
+        except Exception as e:
+            error = repr(e)
+        latency_ms = (time.perf_counter() - start) * 1000
+
+        move = find_answer(response, 'UCI') if response else None
+        try:
+            legal = move is not None and board.is_legal(chess.Move.from_uci(move))
+        except chess.InvalidMoveError:
+            legal = False
+        references = features['reference'].split()
+        row = {column: features[column] for column in COLUMNS if column in features}
+        row.update(move=move or '', legal=legal, correct=legal and move in references,
+                   latency_ms=round(latency_ms, 3), error=error, response=response)
+        return row
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class ResultWriter:
+    # Parquet when pyarrow is installed, CSV with the same columns otherwise
+    def __init__(self, path, batch_size=1024):
+        if path.endswith('.parquet') and pyarrow is None:
+            path = path[:-len('.parquet')] + '.csv'
+            log.warning('pyarrow is not installed, writing %s instead', path)
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        self.parquet = None
+        self.csv_file = None
+        self.csv = None
+        if path.endswith('.parquet'):
+            self.schema = pyarrow.schema([(column, pyarrow.bool_() if column in ('legal', 'correct') else
+                                           pyarrow.float64() if column in ('latency_ms', 'feature_ms') else
+                                           pyarrow.int64() if column in ('tokens', 'static_tokens', 'legal_moves') else
+                                           pyarrow.string()) for column in COLUMNS])
+            self.parquet = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.csv_file = open(path, 'w', newline='')
+            self.csv = csv.DictWriter(self.csv_file, fieldnames=COLUMNS)
+            self.csv.writeheader()
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.parquet is not None:
+            # One row group per batch keeps memory flat however long the run is
+            columns = {column: [row[column] for row in self.rows] for column in COLUMNS}
+            self.parquet.write_table(pyarrow.table(columns, schema=self.schema))
+        else:
+            self.csv.writerows(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.parquet is not None:
+            self.parquet.close()
+        else:
+            self.csv_file.close()
+
+
+class EvalStats:
+    def __init__(self, window=10000):
+        self.positions = 0
+        self.answered = 0
+        self.legal = 0
+        self.scored = 0
+        self.correct = 0
+        self.errors = 0
+        self.tokens = 0
+        self.feature_ms = 0.0
+        self.latencies = deque(maxlen=window)
+        self.phases = Counter()
+        self.phase_correct = Counter()
+        self.start = time.perf_counter()
+
+    def add(self, row):
+        self.positions += 1
+        self.tokens += row['tokens']
+        self.feature_ms += row['feature_ms']
+        self.latencies.append(row['latency_ms'])
+        if row['error']:
+            self.errors += 1
+        if row['move']:
+            self.answered += 1
+        if row['legal']:
+            self.legal += 1
+        if row['reference']:
+            self.scored += 1
+            self.phases[row['phase']] += 1
+            if row['correct']:
+                self.correct += 1
+                self.phase_correct[row['phase']] += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            'positions': self.positions,
+            'answered': self.answered,
+            'errors': self.errors,
+            'legal_rate': self.legal / self.positions if self.positions else 0.0,
+            'accuracy': self.correct / self.scored if self.scored else 0.0,
+            'accuracy_by_phase': {phase: self.phase_correct[phase] / count for phase, count in self.phases.items()},
+            'prompt_tokens': self.tokens,
+            'elapsed_s': round(elapsed, 3),
+            'positions_per_minute': 60 * self.positions / elapsed if elapsed else 0.0,
+            'feature_ms_per_position': self.feature_ms / self.positions if self.positions else 0.0,
+            'latency_p50_ms': percentile(self.latencies, 0.5),
+            'latency_p95_ms': percentile(self.latencies, 0.95),
+        }
+
+
+def run_eval(paths, output, agent, processes=None, concurrency=32, timeout=None, limit=None,
+             min_ply=0, max_ply=None, every=1, batch_size=4096):
+    positions = itertools.islice(iter_positions(paths, min_ply, max_ply, every), limit)
+    dispatcher = Dispatcher(agent, concurrency, timeout)
+    writer = ResultWriter(output)
+    stats = EvalStats()
+    processes = processes or os.cpu_count()
+    try:
+        with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+            # Pool.imap reads its whole input up front, hand it the stream a batch at a time
+            while True:
+                batch = list(itertools.islice(positions, batch_size))
+                if not batch:
+                    break
+                for features in pool.imap(featurize, batch, chunksize=max(1, len(batch) // (4 * processes))):
+                    if features is None:
+                        continue
+                    for row in dispatcher.submit(features):
+                        stats.add(row)
+                        writer.write(row)
+                log.info('%d positions evaluated, %.0f per minute', stats.positions, stats.summary()['positions_per_minute'])
+        for row in dispatcher.collect():
+            stats.add(row)
+            writer.write(row)
+    finally:
+        dispatcher.close()
+        writer.close()
+
+    summary = stats.summary()
+    summary['output'] = writer.path
+    with open(os.path.splitext(writer.path)[0] + '.stats.json', 'w') as out:
+        json.dump(summary, out, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score the proposer prompt against reference moves from PGN/FEN/EPD files.')
+    parser.add_argument('paths', nargs='+', help='.pgn files, or files with one FEN (plus reference UCI moves) or EPD record per line')
+    parser.add_argument('-o', '--output', default='eval.parquet', help='falls back to CSV when pyarrow is missing')
+    parser.add_argument('--gpt-url', default=GPT_BASE_URL, help='any OpenAI compatible endpoint')
+    parser.add_argument('--model', default='gpt-4')
+    parser.add_argument('--concurrency', type=int, default=32, help='completions in flight')
+    parser.add_argument('--processes', type=int, default=None, help='prompt building processes (default: one per CPU)')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds allowed per completion')
+    parser.add_argument('--stream', action='store_true', help='stream completions and stop at the UCI answer')
+    parser.add_argument('--cache', default=None, help='SQLite response cache, so reruns of an unchanged prompt are free')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--min-ply', type=int, default=0)
+    parser.add_argument('--max-ply', type=int, default=None)
+    parser.add_argument('--every', type=int, default=1, help='only take every nth ply of each game')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+
+    agent = GPTAgent(cache=ResponseCache(args.cache) if args.cache else None, base_url=args.gpt_url, stream=args.stream, model=args.model)
+    agent.transport = Transport(pool_size=args.concurrency)
+    summary = run_eval(args.paths, args.output, agent, args.processes, args.concurrency, args.timeout, args.limit,
+                       args.min_ply, args.max_ply, args.every)
+    log.info('Summary: %s', json.dumps(summary))
@@ -0,0 +1,61 @@
+import os
+import sys
+import timeit
+
+import chess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from move_annotations import MoveAnnotator, annotate_moves
+
+
+# Dense middlegame positions with plenty of captures, checks and pins
+POSITIONS = [
+    'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP2BPPP/R2QKB1R w KQ - 0 9',
+    'r2q1rk1/1b1nbppp/p2ppn2/1p6/3NPP2/1BN1B3/PPPQ2PP/2KR3R w - - 0 12',
+    'r1b2rk1/2q1bppp/p2p1n2/np2p3/3PP3/5N1P/PPB2PP1/RNBQR1K1 w - - 0 13',
+    '2kr3r/pppq1ppp/2nbbn2/3pp3/3PP3/2NBBN2/PPPQ1PPP/2KR3R w - - 0 10',
+    'r4rk1/1Q3ppp/p1n1p3/3qN3/3P4/P3B3/1P3PPP/R4RK1 b - - 0 20',
+    '6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1',
+]
+
+
+def naive_annotations(board):
+    # The old format_moves approach: re-parse each move and push/pop to test for mate
+    out = []
+    for move in list(board.legal_moves):
+        move = chess.Move.from_uci(move.uci())
+        if board.is_en_passant(move):
+            captured = chess.PAWN
+        elif board.is_capture(move):
+            captured = board.piece_at(move.to_square).piece_type
+        else:
+            captured = None
+        check = board.gives_check(move)
+        mate = False
+        if check:
+            board.push(move)
+            mate = board.is_checkmate()
+            board.pop()
+        out.append((move, captured, check, mate))
+    return out
+
+
+def main(number=200):
+    boards = [chess.Board(fen) for fen in POSITIONS]
+    for board in boards:
+        fast = [(a.move, a.captured, a.check, a.mate) for a in annotate_moves(board)]
+        assert fast == naive_annotations(board), board.fen()
+
+    naive = timeit.timeit(lambda: [naive_annotations(board) for board in boards], number=number)
+    cold = timeit.timeit(lambda: [annotate_moves(board) for board in boards], number=number)
+    annotator = MoveAnnotator()
+    memoized = timeit.timeit(lambda: [annotator.annotate(board) for board in boards], number=number)
+
+    per_position = number * len(boards) / 1000
+    print(f'naive push/pop:   {naive / per_position:.3f} ms/position')
+    print(f'bitboard pass:    {cold / per_position:.3f} ms/position')
+    print(f'memoized:         {memoized / per_position:.3f} ms/position')
+
+
+if __name__ == '__main__':
+    main()
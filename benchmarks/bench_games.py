@@ -0,0 +1,218 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mock_servers
+from chess_client import ChessClient
+from game_sessions import GameSessions
+from game_store import GameStore, game_outcome
+from response_cache import ResponseCache
+from metrics import log, percentile, tracer
+
+
+# Spans that are the client waiting on a server rather than computing
+NETWORK_SPANS = ('proposer', 'critic', 'light', 'make_move')
+LOCAL_SPANS = ('prompt', 'legality', 'tactics', 'veto')
+
+
+class MeteredClient(ChessClient):
+    # Thread CPU time spent building prompts. The prompt spans are wall clock
+    # and with several games on one interpreter they include waiting for the GIL.
+    cpu = Counter()
+    cpu_lock = threading.Lock()
+
+    def build_prompt(self, *args, **kwargs):
+        start = time.thread_time()
+        try:
+            return super().build_prompt(*args, **kwargs)
+        finally:
+            self.charge('prompt', time.thread_time() - start)
+
+    def build_critic_prompt(self, *args, **kwargs):
+        start = time.thread_time()
+        try:
+            return super().build_critic_prompt(*args, **kwargs)
+        finally:
+            self.charge('critic_prompt', time.thread_time() - start)
+
+    def charge(self, name, seconds):
+        with self.cpu_lock:
+            self.cpu[name] += seconds
+            self.cpu[name + '_calls'] += 1
+
+
+def distribution(values):
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': sum(values) / len(values),
+        'min_ms': min(values),
+        'p50_ms': percentile(values, 0.5),
+        'p90_ms': percentile(values, 0.9),
+        'p95_ms': percentile(values, 0.95),
+        'p99_ms': percentile(values, 0.99),
+        'max_ms': max(values),
+        'total_ms': sum(values),
+    }
+
+
+def start_servers(args):
+    # The stand-ins get their own process so the client's CPU time is its own
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=mock_servers.serve, args=(args, sender), name='mock-servers', daemon=True)
+    server.start()
+    if not receiver.poll(30):
+        server.terminate()
+        raise RuntimeError('Mock servers did not start')
+    return server, receiver.recv()
+
+
+def play(args, index, lichess_url, gpt_url, cache, sessions, store):
+    client = MeteredClient(cache=cache, base_url=lichess_url, ponder=args.ponder, fan_out=args.fan_out,
+                           deadline=args.deadline, book=args.book, stream=args.stream, tactics=args.tactics,
+                           sessions=sessions, route=args.route, store=store)
+    for agent in (client.agent, client.critic_agent, client.light_agent):
+        if agent is not None:
+            agent.base_url = gpt_url
+    start = time.perf_counter()
+    game = {'index': index, 'game_id': None, 'status': None}
+    try:
+        game['game_id'] = client.start_challenge('ai')
+        game['status'] = client.play_game()
+    except Exception as e:
+        log.exception('Game %d failed', index)
+        game['error'] = repr(e)
+    game.update(color=client.color, winner=client.winner, plies=client.board.ply(),
+                seconds=time.perf_counter() - start)
+    return game
+
+
+def read_traces(path):
+    spans = defaultdict(list)
+    moves = defaultdict(list)
+    by_game = defaultdict(list)
+    with open(path) as handle:
+        for line in handle:
+            record = json.loads(line)
+            spans[record['span']].append(record['ms'])
+            # Only moves that were played: not the forks thinking ahead, nor a
+            # ponder miss, whose move is timed by the compute_next_move after it
+            if record['span'] == 'compute_next_move' and not record.get('ponder') and record.get('hit', True):
+                moves[record.get('source') or 'unknown'].append(record['ms'])
+                by_game[record.get('game')].append(record['ms'])
+    return spans, moves, by_game
+
+
+def run_benchmark(args):
+    server, (lichess_url, gpt_url) = start_servers(args)
+    workdir = tempfile.mkdtemp(prefix='bench_games_')
+    if args.book is not None:
+        # Given relative to where the benchmark was started
+        args.book = os.path.abspath(args.book)
+    os.chdir(workdir)
+    tracer.path = os.path.join(workdir, 'traces.jsonl')
+    cache = ResponseCache(path=None)
+    sessions = GameSessions(os.path.join(workdir, 'games.json'))
+    store = GameStore(os.path.join(workdir, 'games.sqlite'))
+    log.info('Playing %d games against %s and %s, working in %s', args.games, lichess_url, gpt_url, workdir)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='game') as pool:
+            games = list(pool.map(lambda index: play(args, index, lichess_url, gpt_url, cache, sessions, store),
+                                  range(args.games)))
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        tracer.flush()
+        store.flush()
+        server_stats = {name: requests.get(f'{url}/_stats', timeout=5).json()
+                        for name, url in (('lichess', lichess_url), ('openai', gpt_url))}
+    finally:
+        server.terminate()
+        server.join()
+    store_stats = store.stats()
+    store.close()
+
+    spans, moves, by_game = read_traces(tracer.path)
+    for game in games:
+        game['moves'] = len(by_game.get(game['game_id'], []))
+        game['move_p50_ms'] = percentile(by_game.get(game['game_id'], []), 0.5)
+    finished = [game for game in games if 'error' not in game]
+    all_moves = [ms for values in moves.values() for ms in values]
+    prompt_cpu = MeteredClient.cpu['prompt'] + MeteredClient.cpu['critic_prompt']
+    network = {name: sum(spans.get(name, [])) / 1000 for name in NETWORK_SPANS}
+    local = {name: sum(spans.get(name, [])) / 1000 for name in LOCAL_SPANS}
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'games': {
+            'played': len(games),
+            'finished': len(finished),
+            'statuses': Counter(game['status'] for game in finished),
+            'outcomes': Counter(game_outcome(game['color'], game['status'], game['winner']) for game in finished),
+            'plies': sum(game['plies'] for game in games),
+            'moves': len(all_moves),
+            'wall_s': wall,
+            'games_per_hour': 3600 * len(finished) / wall if wall else 0.0,
+            'moves_per_minute': 60 * len(all_moves) / wall if wall else 0.0,
+        },
+        'move_latency': dict(distribution(all_moves), by_source={source: distribution(values) for source, values in sorted(moves.items())}),
+        'time': {
+            # Summed over threads, with several games in flight these add up to more than the wall clock
+            'prompt_cpu_s': prompt_cpu,
+            'prompt_wall_s': local['prompt'],
+            'prompts_built': MeteredClient.cpu['prompt_calls'] + MeteredClient.cpu['critic_prompt_calls'],
+            'network_wait_s': dict(network, total=sum(network.values())),
+            'local_s': local,
+            'process_cpu_s': cpu,
+            'cpu_utilisation': cpu / wall if wall else 0.0,
+        },
+        'spans': {name: distribution(values) for name, values in sorted(spans.items())},
+        'cache': cache.stats(),
+        'store': store_stats,
+        'servers': server_stats,
+        'per_game': games,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play complete games against local Lichess and OpenAI stand-ins and report throughput.')
+    parser.add_argument('-o', '--output', default='bench_games.json')
+    parser.add_argument('--games', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=2, help='games played at once')
+    parser.add_argument('--ponder', action='store_true')
+    parser.add_argument('--fan-out', type=int, default=0)
+    parser.add_argument('--deadline', type=float, default=30.0)
+    parser.add_argument('--book', default=None)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--tactics', action='store_true')
+    parser.add_argument('--route', action='store_true')
+    parser.add_argument('--log-level', default='WARNING')
+    mock_servers.add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(threadName)s %(message)s')
+    output = os.path.abspath(args.output)
+
+    report = run_benchmark(args)
+    with open(output, 'w') as out:
+        json.dump(report, out, indent=2)
+    games, latency, spent = report['games'], report['move_latency'], report['time']
+    print(f'games:        {games["finished"]}/{games["played"]} finished, {games["games_per_hour"]:.1f} per hour')
+    print(f'moves:        {games["moves"]}, p50 {latency.get("p50_ms", 0):.0f} ms, p95 {latency.get("p95_ms", 0):.0f} ms, '
+          f'p99 {latency.get("p99_ms", 0):.0f} ms')
+    print(f'prompt CPU:   {spent["prompt_cpu_s"]:.2f} s over {spent["prompts_built"]} prompts')
+    print(f'network wait: {spent["network_wait_s"]["total"]:.2f} s')
+    print(f'process CPU:  {spent["process_cpu_s"]:.2f} s of {games["wall_s"]:.2f} s wall')
+    print(f'report:       {output}')
@@ -0,0 +1,489 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+import zlib
+from collections import Counter
+
+import chess
+import chess.pgn
+from aiohttp import web
+
+
+# Lichess reports games without a clock with this much time left
+UNLIMITED_MS = 2147483647
+PIECE_VALUES = {chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9, chess.KING: 0}
+FEN_PATTERN = re.compile(r'^FEN: (.+)$', re.MULTILINE)
+PROPOSED_PATTERN = re.compile(r'^OUR PROPOSED MOVE: (\S+)', re.MULTILINE)
+REASONING = ('Looking at the position the opponent has no immediate threat against our king and our pieces are '
+             'defended. Checking every capture and check first, then weighing development, king safety and central '
+             'control before settling on a move that keeps material level.').split()
+
+
+def load_library(paths):
+    # Recorded games: their move lists for the opponent to replay, and the move
+    # played in every position for the proposer to answer with
+    lines = []
+    moves = {}
+    for path in paths or []:
+        with open(path, encoding='utf-8', errors='replace') as handle:
+            while True:
+                game = chess.pgn.read_game(handle)
+                if game is None:
+                    break
+                if game.headers.get('Variant', 'Standard') != 'Standard' or 'FEN' in game.headers:
+                    continue
+                board = game.board()
+                line = []
+                for move in game.mainline_moves():
+                    moves.setdefault(board.epd(), move.uci())
+                    line.append(move.uci())
+                    board.push(move)
+                if line:
+                    lines.append(line)
+    return lines, moves
+
+
+def greedy_move(board, rng):
+    # Mate if there is one, else the most valuable capture, else anything
+    best = []
+    best_value = -1
+    for move in board.legal_moves:
+        if board.gives_check(move):
+            board.push(move)
+            mate = board.is_checkmate()
+            board.pop()
+            if mate:
+                return move
+        if board.is_en_passant(move):
+            value = PIECE_VALUES[chess.PAWN]
+        elif board.is_capture(move):
+            value = PIECE_VALUES[board.piece_type_at(move.to_square)]
+        else:
+            value = 0
+        if value > best_value:
+            best, best_value = [move], value
+        elif value == best_value:
+            best.append(move)
+    return rng.choice(best)
+
+
+def parse_clock(text):
+    # '300+3' is five minutes plus three seconds a move, returned in milliseconds
+    if not text:
+        return None
+    limit, _, increment = text.partition('+')
+    return int(float(limit) * 1000), int(float(increment or 0) * 1000)
+
+
+class MockGame:
+    def __init__(self, game_id, bot_color, board, clock, line, rng):
+        self.id = game_id
+        self.bot_color = bot_color
+        self.board = board
+        self.initial_fen = board.fen()
+        self.moves = []
+        self.clock = clock
+        initial = clock[0] if clock is not None else UNLIMITED_MS
+        self.times = {chess.WHITE: initial, chess.BLACK: initial}
+        self.turn_started = time.monotonic()
+        self.flag_timer = None
+        self.line = line
+        self.rng = rng
+        self.status = 'started'
+        self.winner = None
+        self.created = int(time.time() * 1000)
+        self.version = 0
+        self.updated = asyncio.Event()
+
+    def notify(self):
+        self.version += 1
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    def play(self, move):
+        now = time.monotonic()
+        mover = self.board.turn
+        if self.clock is not None:
+            self.times[mover] -= int((now - self.turn_started) * 1000)
+            if self.times[mover] <= 0:
+                self.times[mover] = 0
+                self.finish('outoftime', not mover)
+                return
+            self.times[mover] += self.clock[1]
+        self.turn_started = now
+        self.board.push(move)
+        self.moves.append(move.uci())
+        if self.board.is_checkmate():
+            self.finish('mate', mover)
+        elif self.board.is_stalemate():
+            self.finish('stalemate')
+        elif (self.board.is_insufficient_material() or self.board.is_seventyfive_moves() or
+              self.board.is_repetition(3)):
+            self.finish('draw')
+        else:
+            self.start_flag_timer()
+            self.notify()
+
+    def start_flag_timer(self):
+        if self.flag_timer is not None:
+            self.flag_timer.cancel()
+            self.flag_timer = None
+        if self.clock is not None:
+            ply = len(self.moves)
+            self.flag_timer = asyncio.get_running_loop().call_later(
+                self.times[self.board.turn] / 1000, self.flag, ply)
+
+    def flag(self, ply):
+        if self.status == 'started' and len(self.moves) == ply:
+            self.times[self.board.turn] = 0
+            self.finish('outoftime', not self.board.turn)
+
+    def finish(self, status, winner=None):
+        if self.flag_timer is not None:
+            self.flag_timer.cancel()
+            self.flag_timer = None
+        self.status = status
+        self.winner = None if winner is None else chess.COLOR_NAMES[winner]
+        self.notify()
+
+    def state(self):
+        state = {
+            'type': 'gameState',
+            'moves': ' '.join(self.moves),
+            'wtime': self.times[chess.WHITE],
+            'btime': self.times[chess.BLACK],
+            'winc': self.clock[1] if self.clock is not None else 0,
+            'binc': self.clock[1] if self.clock is not None else 0,
+            'status': self.status,
+        }
+        if self.winner is not None:
+            state['winner'] = self.winner
+        return state
+
+
+class MockLichess:
+    # The Board API endpoints ChessClient uses, against a built in opponent
+    # that replays recorded games while the bot follows them and otherwise
+    # plays greedily. Streams are NDJSON with keepalive newlines, like Lichess.
+    def __init__(self, options, lines=None):
+        self.options = options
+        self.lines = lines or []
+        self.clock = parse_clock(options.clock)
+        self.games = {}
+        self.ids = itertools.count(1)
+        self.stats = Counter()
+        self.tasks = set()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/api/challenge/{username}', self.challenge)
+        app.router.add_get('/api/bot/game/stream/{game_id}', self.stream)
+        app.router.add_post('/api/bot/game/{game_id}/move/{move}', self.move)
+        app.router.add_post('/api/bot/game/{game_id}/chat', self.chat)
+        app.router.add_get('/_stats', self.report)
+        return app
+
+    def player(self, game, color):
+        if color == game.bot_color:
+            return {'id': self.options.username.lower(), 'name': self.options.username, 'title': 'BOT', 'rating': 1500}
+        return {'aiLevel': self.options.ai_level}
+
+    def full(self, game):
+        clock = None
+        if game.clock is not None:
+            clock = {'initial': game.clock[0], 'increment': game.clock[1]}
+        return {
+            'type': 'gameFull',
+            'id': game.id,
+            'rated': False,
+            'variant': {'key': 'standard', 'name': 'Standard', 'short': 'Std'},
+            'clock': clock,
+            'speed': 'correspondence' if clock is None else 'rapid',
+            'perf': {'name': 'Correspondence' if clock is None else 'Rapid'},
+            'createdAt': game.created,
+            'white': self.player(game, chess.WHITE),
+            'black': self.player(game, chess.BLACK),
+            'initialFen': 'startpos' if game.initial_fen == chess.STARTING_FEN else game.initial_fen,
+            'state': game.state(),
+        }
+
+    async def challenge(self, request):
+        body = await request.json() if request.can_read_body else {}
+        index = next(self.ids)
+        rng = random.Random(self.options.seed * 1000003 + index)
+        color = body.get('color', 'random')
+        if color == 'random':
+            color = rng.choice(chess.COLOR_NAMES)
+        fen = body.get('fen')
+        board = chess.Board(fen) if fen else chess.Board()
+        line = self.lines[(index - 1) % len(self.lines)] if self.lines and not fen else None
+        game = MockGame(f'mock{index:04d}', chess.COLOR_NAMES.index(color), board, self.clock, line, rng)
+        self.games[game.id] = game
+        self.stats['games'] += 1
+        game.start_flag_timer()
+        self.schedule_opponent(game)
+
+        username = request.match_info['username']
+        if username == 'ai':
+            return web.json_response({'id': game.id, 'variant': {'key': 'standard'}, 'fen': game.initial_fen,
+                                      'player': color, 'turns': 0, 'source': 'ai',
+                                      'status': {'id': 20, 'name': 'started'}, 'createdAt': game.created})
+        # Challenges to players stream the challenge and then whether it was accepted
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        await response.write(web_json({'challenge': {'id': game.id, 'color': color, 'status': 'created'}}))
+        await response.write(web_json({'done': 'accepted'}))
+        await response.write_eof()
+        return response
+
+    def schedule_opponent(self, game):
+        if game.status != 'started' or game.board.turn == game.bot_color:
+            return
+        task = asyncio.ensure_future(self.opponent(game))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def opponent(self, game):
+        await asyncio.sleep(self.options.opponent_delay * (0.5 + game.rng.random()))
+        if game.status != 'started' or game.board.turn == game.bot_color:
+            return
+        ply = len(game.moves)
+        if game.line is not None and ply < len(game.line) and game.moves == game.line[:ply]:
+            move = chess.Move.from_uci(game.line[ply])
+            self.stats['replayed'] += 1
+        else:
+            move = greedy_move(game.board, game.rng)
+            self.stats['greedy'] += 1
+        game.play(move)
+        if game.status == 'started' and len(game.moves) >= self.options.max_plies:
+            # Adjudicated so a benchmark game cannot run forever
+            game.finish('draw')
+
+    async def stream(self, request):
+        game = self.games.get(request.match_info['game_id'])
+        if game is None:
+            return web.json_response({'error': 'Not found'}, status=404)
+        self.stats['streams'] += 1
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        events = 1
+        try:
+            await response.write(web_json(self.full(game)))
+            version = game.version
+            while game.status == 'started':
+                if self.options.drop_every and events % self.options.drop_every == 0:
+                    # Cut the connection like a load balancer would, the client has to resume
+                    self.stats['dropped'] += 1
+                    break
+                if version == game.version:
+                    try:
+                        await asyncio.wait_for(game.updated.wait(), self.options.keepalive)
+                    except asyncio.TimeoutError:
+                        await response.write(b'\n')
+                        continue
+                version = game.version
+                await response.write(web_json(game.state()))
+                events += 1
+        except ConnectionResetError:
+            self.stats['stream_resets'] += 1
+        return response
+
+    async def move(self, request):
+        game = self.games.get(request.match_info['game_id'])
+        if game is None:
+            return web.json_response({'error': 'Not found'}, status=404)
+        await asyncio.sleep(self.options.lichess_latency)
+        self.stats['moves'] += 1
+        try:
+            move = chess.Move.from_uci(request.match_info['move'])
+        except ValueError:
+            move = None
+        if (game.status != 'started' or game.board.turn != game.bot_color or move not in game.board.legal_moves or
+                game.rng.random() < self.options.reject_rate):
+            self.stats['rejected'] += 1
+            return web.json_response({'error': 'Not your turn, or game already over'}, status=400)
+        game.play(move)
+        if game.status == 'started' and len(game.moves) >= self.options.max_plies:
+            game.finish('draw')
+        self.schedule_opponent(game)
+        return web.json_response({'ok': True})
+
+    async def chat(self, request):
+        self.stats['chat'] += 1
+        return web.json_response({'ok': True})
+
+    async def report(self, request):
+        statuses = Counter(game.status for game in self.games.values())
+        return web.json_response(dict(self.stats, statuses=statuses))
+
+
+class MockOpenAI:
+    # /v1/chat/completions with a latency model of a fixed time to first token
+    # plus a token rate, plain or streamed as SSE. Proposers get a legal move
+    # (the recorded one when the position is in the library), critics approve
+    # at a set rate, and rate limits and illegal answers can be injected.
+    def __init__(self, options, moves=None):
+        self.options = options
+        self.moves = moves or {}
+        self.rng = random.Random(options.seed)
+        self.stats = Counter()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.completions)
+        app.router.add_get('/_stats', self.report)
+        return app
+
+    def answer(self, prompt, rng):
+        fen = FEN_PATTERN.search(prompt)
+        if fen is None:
+            return 'I could not find the position.'
+        if PROPOSED_PATTERN.search(prompt):
+            self.stats['critic'] += 1
+            approved = rng.random() < self.options.approve_rate
+            return 'STATUS: SUCCESS' if approved else 'STATUS: FAIL'
+        self.stats['proposer'] += 1
+        board = chess.Board(fen.group(1))
+        legal = list(board.legal_moves)
+        if rng.random() < self.options.illegal_rate or not legal:
+            self.stats['illegal'] += 1
+            while True:
+                move = chess.Move(rng.choice(chess.SQUARES), rng.choice(chess.SQUARES))
+                if move not in legal and move.from_square != move.to_square:
+                    return f'UCI: {move.uci()}'
+        recorded = self.moves.get(board.epd())
+        if recorded is not None:
+            self.stats['recorded'] += 1
+            return f'UCI: {recorded}'
+        captures = [move for move in legal if board.is_capture(move)]
+        return f'UCI: {rng.choice(captures if captures and rng.random() < 0.5 else legal).uci()}'
+
+    def content(self, prompt):
+        # Same prompt, same answer, so runs are repeatable
+        rng = random.Random(zlib.crc32(prompt.encode('utf-8')) ^ self.options.seed)
+        words = [REASONING[i % len(REASONING)] for i in range(self.options.reasoning_words)]
+        return ' '.join(words) + '\n' + self.answer(prompt, rng)
+
+    def generation_time(self, content):
+        return len(content) / 4 / self.options.tokens_per_second
+
+    async def completions(self, request):
+        body = await request.json()
+        self.stats['requests'] += 1
+        if self.rng.random() < self.options.gpt_error_rate:
+            self.stats['rate_limited'] += 1
+            return web.json_response({'error': {'message': 'Rate limit reached', 'type': 'requests'}}, status=429)
+        prompt = body['messages'][-1]['content']
+        content = self.content(prompt)
+        self.stats['prompt_tokens'] += len(prompt) // 4
+        self.stats['completion_tokens'] += len(content) // 4
+        jitter = self.options.gpt_jitter
+        first_token = self.options.gpt_latency * self.rng.uniform(1 - jitter, 1 + jitter)
+        created = int(time.time())
+
+        if not body.get('stream'):
+            await asyncio.sleep(first_token + self.generation_time(content))
+            return web.json_response({
+                'id': f'chatcmpl-{self.stats["requests"]}',
+                'object': 'chat.completion',
+                'created': created,
+                'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(content) // 4},
+            })
+
+        self.stats['streamed'] += 1
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        await asyncio.sleep(first_token)
+        try:
+            words = content.split(' ')
+            for start in range(0, len(words), 3):
+                piece = ' '.join(words[start:start + 3]) + ' '
+                chunk = {'object': 'chat.completion.chunk', 'created': created, 'model': body.get('model'),
+                         'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]}
+                await response.write(b'data: ' + web_json(chunk) + b'\n')
+                await asyncio.sleep(self.generation_time(piece))
+            done = {'object': 'chat.completion.chunk', 'created': created, 'model': body.get('model'),
+                    'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+            await response.write(b'data: ' + web_json(done) + b'\n')
+            await response.write(b'data: [DONE]\n\n')
+        except ConnectionResetError:
+            # The client stops reading once it has the answer
+            self.stats['aborted'] += 1
+        return response
+
+    async def report(self, request):
+        return web.json_response(dict(self.stats))
+
+
+def web_json(payload):
+    return (json.dumps(payload) + '\n').encode('utf-8')
+
+
+async def start(options):
+    lines, moves = load_library(options.pgn)
+    runners = []
+    urls = []
+    for app, port in ((MockLichess(options, lines).app(), options.lichess_port),
+                      (MockOpenAI(options, moves).app(), options.gpt_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, options.host, port).start()
+        runners.append(runner)
+        urls.append(f'http://{options.host}:{runner.addresses[0][1]}')
+    return runners, urls
+
+
+def serve(options, ready=None):
+    # Runs both stand-ins until the process is stopped, ready (a Pipe end)
+    # receives the Lichess and OpenAI base URLs once they are listening
+    async def main():
+        runners, urls = await start(options)
+        if ready is not None:
+            ready.send(urls)
+        else:
+            print(f'Lichess: {urls[0]}\nOpenAI:  {urls[1]}', flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            for runner in runners:
+                await runner.cleanup()
+
+    asyncio.run(main())
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('mock servers')
+    group.add_argument('--host', default='127.0.0.1')
+    group.add_argument('--lichess-port', type=int, default=0, help='0 picks a free port')
+    group.add_argument('--gpt-port', type=int, default=0, help='0 picks a free port')
+    group.add_argument('--pgn', nargs='*', default=[], help='recorded games for the opponent and the proposer to replay')
+    group.add_argument('--seed', type=int, default=0)
+    group.add_argument('--username', default='bot', help='name the bot has in gameFull events')
+    group.add_argument('--ai-level', type=int, default=2)
+    group.add_argument('--clock', default=None, help='e.g. 300+3, unlimited when omitted')
+    group.add_argument('--max-plies', type=int, default=160, help='games this long are adjudicated a draw')
+    group.add_argument('--opponent-delay', type=float, default=0.2, help='mean opponent think time in seconds')
+    group.add_argument('--keepalive', type=float, default=6.0, help='seconds between keepalive newlines')
+    group.add_argument('--drop-every', type=int, default=0, help='cut game streams after this many events')
+    group.add_argument('--reject-rate', type=float, default=0.0, help='share of bot moves refused with a 400')
+    group.add_argument('--lichess-latency', type=float, default=0.02, help='seconds before a move is accepted')
+    group.add_argument('--gpt-latency', type=float, default=0.3, help='mean seconds to the first token')
+    group.add_argument('--gpt-jitter', type=float, default=0.5, help='time to first token varies by this fraction')
+    group.add_argument('--tokens-per-second', type=float, default=200.0)
+    group.add_argument('--reasoning-words', type=int, default=60, help='words of reasoning before the answer')
+    group.add_argument('--illegal-rate', type=float, default=0.05, help='share of proposals that are illegal moves')
+    group.add_argument('--approve-rate', type=float, default=0.7, help='share of proposals the critic approves')
+    group.add_argument('--gpt-error-rate', type=float, default=0.0, help='share of completions answered with 429')
+    return group
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-ins for the Lichess Board API and OpenAI chat completions.')
+    add_arguments(parser)
+    serve(parser.parse_args())
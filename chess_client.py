@@ -1,21 +1,49 @@
-import requests
-from config import LICHESS_BASE_URL, LICHESS_HEADERS
-from secret import LICHESS_USERNAME
+from config import LICHESS_BASE_URL, LICHESS_HEADERS, LICHESS_USERNAME, OPENING_BOOK_PATH, METRICS_PATH
+import argparse
 import json
+import logging
+import requests
+import os
 import chess
 import chess.svg
 import random
-from gpt_client import GPTAgent
+import copy
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from gpt_client import GPTAgent, find_answer
+from response_cache import ResponseCache
+from ponder import Ponderer
+from move_annotations import annotator
+from opening_book import OpeningBook
+from prompt_builder import PromptBuilder
+from transport import SendQueue, transport
+from tactics import TacticalSearcher
+from scheduler import Deadline, DeadlineExceeded, MoveScheduler
+from game_sessions import GameSessions
+from router import Router
+from game_store import GameStore
+from metrics import log, tracer
 
 
 class ChessClient:
-    def __init__(self, fen=None):
+    def __init__(self, fen=None, cache=None, base_url=LICHESS_BASE_URL, ponder=False, fan_out=0, deadline=30.0, book=None, stream=False, tactics=False, scheduler=None, sessions=None, route=False, store=None):
         self.fen = fen
+        self.base_url = base_url
+        self.transport = transport
+        self.send_queue = SendQueue(self.transport)
         self.color = None
         if fen != None:
             self.board = chess.Board(fen)
         else:
             self.board = chess.Board()
+        self.initial_fen = self.board.fen()
+        # The server's move list for what is on self.board, so events only need their new suffix parsed
+        self.moves_text = ''
+        # (uci, send future) of our last move until the server has echoed it
+        self.pending_move = None
+        # Set on forks thinking ahead, their moves are only played on a ponder hit
+        self.pondering = False
         self.pieces = {
             chess.PAWN: 'PAWN',
             chess.KNIGHT: 'KNIGHT',
@@ -26,9 +54,30 @@ class ChessClient:
         }
         self.board_image_filepath = 'curr_board.svg'
         self.game_id = None
-        self.agent = GPTAgent()
-        self.critic_agent = GPTAgent()
-        self.color_prompt = f'You are playing as {self.color} in this game of chess. You may also be starting in the middle of a chess game.'
+        self.cache = cache if cache is not None else ResponseCache()
+        self.agent = GPTAgent(role='proposer', cache=self.cache, stream=stream)
+        self.critic_agent = GPTAgent(role='critic', cache=self.cache, stream=stream)
+        self.annotator = annotator
+        self.prompt_builder = PromptBuilder()
+        self.ponderer = Ponderer(self) if ponder else None
+        self.fan_out = fan_out
+        self.deadline = deadline
+        self.pool = None
+        self.book = OpeningBook(book) if book is not None else None
+        self.searcher = TacticalSearcher() if tactics else None
+        self.router = Router() if route else None
+        self.light_agent = GPTAgent(role='proposer', cache=self.cache, stream=stream, model=self.router.light_model) if route else None
+        self.scheduler = scheduler if scheduler is not None else MoveScheduler()
+        for agent in (self.agent, self.critic_agent, self.light_agent):
+            if agent is not None:
+                agent.on_latency = self.scheduler.record_query
+        self.sessions = sessions if sessions is not None else GameSessions()
+        self.store = store if store is not None else GameStore()
+        # Prompts and responses behind the move being computed, and what that move was based on
+        self.transcript = []
+        self.last_decision = None
+        self.winner = None
+        self.stream_events = 0
         self.critic_preamble = 'Please conduct a systematic evaluation of the proposed move. Your role is to identify the greatest threat posed by the enemy, and decide if the proposed move leads to our best outcome. You should begin by first asking why the opponent made that move. Then you should begin your analysis by ensuring our king is not in any immediate danger of being checkmated. We will be passing in all of the moves the opponent can respond with to our proposed move. Each of these moves should be closely analyzed to ensure we do not accidentally sacrifice pieces of value. Prioritize the safety of our most valuable pieces first. When judging a trade, keep in mind the value of different pieces: Queen: 9, Rook: 5, Bishop: 3, Knight: 3, Pawn: 1. If you are ahead materially or about tied then encourage even trades. Encourage trading if it results in us being in an improved position. If you can take an opponents piece with a less valuable piece, then do it. For example, if you can take the opponent Queen with our Rook or the opponent Knight with our pawn, we should do it. I have provided you with the game state, the current position of all pieces, the proposed move, and a list of legal moves the opponent can take. Please reason about this, and state if the move is unreasonable. If the move is unreasonable, please address the biggest threat the opponent has that needs to be addressed. Ensure you evaluate what is gained by the proposed move as well, if we capture their queen and they capture our rook it is still beneficial. If the legal move list contains a move that gives the opponent checkmate, always take that!!! Do not consider any other move if a legal move leads to checkmate.'     
         self.critic_suffix = 'Please end your response in the following format "STATUS: SUCCESS" or "STATUS: FAIL"'
         self.critic_opening = 'Try not to move a piece if it has already been moved from its starting square. \
@@ -51,8 +100,6 @@ class ChessClient:
             If you have an advantage materially try to push towards a checkmate against the opponent.'
 
     def start_challenge(self, username, fen=None):
-        s = requests.Session()
-
         challenge_body = {
             'keepAliveStream': True,
             'color': 'black',
@@ -61,12 +108,12 @@ class ChessClient:
         if self.fen != None:
             challenge_body['fen'] = self.fen
         game_id = None
-        with s.post(f'{LICHESS_BASE_URL}/api/challenge/{username}', headers=LICHESS_HEADERS, json=challenge_body, stream=True) as resp:
-            print('Sent out challenge.')
+        with self.transport.post(f'{self.base_url}/api/challenge/{username}', headers=LICHESS_HEADERS, json=challenge_body, stream=True) as resp:
+            log.info('Sent out challenge.')
             for line in resp.iter_lines():
                 if line:
                     json_resp = json.loads(line)
-                    print(json_resp)
+                    log.debug('Challenge event: %s', json_resp)
                     if 'challenge' in json_resp:
                         game_id = json_resp['challenge']['id']
                         self.color = json_resp['challenge']['color']
@@ -111,21 +158,6 @@ class ChessClient:
 
         return f'{formatted_bot_pos}\n{formatted_opp_pos}'
 
-    def get_legal_moves(self):
-        # moves = list(self.board.legal_moves)
-        legal = {}
-        for move in list(self.board.legal_moves):
-            piece = self.board.piece_at(move.from_square)
-            move_key = (piece.piece_type, chess.square_name(move.from_square))
-            if move_key not in legal:
-                legal[move_key] = []
-            if move.promotion:
-                legal[move_key].append(
-                    f'{chess.square_name(move.to_square)}{chess.piece_symbol(move.promotion)}')
-            else:
-                legal[move_key].append(chess.square_name(move.to_square))
-        return legal
-
     def check(self, move):
         return self.board.gives_check(move)
 
@@ -135,73 +167,16 @@ class ChessClient:
         self.board.pop()
         return checkmate
 
-
-    def format_moves(self, legal_move_dict, color):
-        out = ''
-        for move in legal_move_dict:
-            piece, start = move
-            curr_piece = f'{color} {self.pieces[piece].lower()} ({start}): '
-            for target in legal_move_dict[move]:
-                captured_piece = self.move_capture(chess.Move.from_uci(f'{start}{target}'))
-                is_check = self.check(chess.Move.from_uci(f'{start}{target}'))
-                if is_check and self.checkmate(chess.Move.from_uci(f'{start}{target}')):
-                    curr_piece += f'{target} (CHECKMATES OPPONENT! PLEASE TAKE THIS MOVE), '
-                    continue
-
-                if is_check and captured_piece != None:
-                    curr_piece += f'{target} (capture {captured_piece}, and gives check to opponent), '
-                if captured_piece != None:
-                    curr_piece += f'{target} (capture {captured_piece}), '
-                if is_check:
-                    curr_piece += f'{target} (gives check to opponent), '
-                else:
-                    curr_piece += f'{target}, '
-            out += curr_piece[:-2] + '\n'
-        return out
-    
-    def get_attacked_squares(self, opp_color):
-        attacks = {}
-        for piece in self.pieces:
-            squares = self.board.pieces(piece, self.color == 'white')
-            for square in squares:
-                attacked = self.board.attacks(square)
-                for atk in attacked:
-                    # opp_color = opp_color == 'white'
-                    if self.board.piece_at(atk) != None and self.board.color_at(atk) == opp_color:
-                        if chess.piece_name(piece) not in attacks:
-                            attacks[(chess.piece_name(piece), chess.square_name(square))] = []
-                        attacks[(chess.piece_name(piece), chess.square_name(square))].append(chess.square_name(atk))
-        print(attacks)
-        return attacks
-    
-    def format_attacks(self, attacks):
-        out = ''
-        for move in attacks:
-            piece, start = move
-            curr_piece = f'{piece} ({start}): '
-            for target in attacks[move]:
-                captured_piece = self.move_capture(chess.Move.from_uci(f'{start}{target}'))
-                curr_piece += f'{target} (capture {captured_piece}), '
-
-            out += curr_piece[:-2] + '\n'
-        return out
-    
-    def get_attacks(self, opp_color):
-        return self.format_attacks(self.get_attacked_squares(opp_color))
-
-    def get_moves(self, color):
-        return self.format_moves(self.get_legal_moves(), color)
-
     def is_legal(self, proposed_move):
-        return chess.Move.from_uci(proposed_move) in list(self.board.legal_moves)      
+        return self.board.is_legal(chess.Move.from_uci(proposed_move))
 
     def write_to_chat(self, message):
         body = {
             'room': 'player',
             'text': message
         }
-        requests.post(f'{LICHESS_BASE_URL}/api/bot/game/{self.game_id}/chat',
-                      headers=LICHESS_HEADERS, json=body)
+        return self.send_queue.submit('POST', f'{self.base_url}/api/bot/game/{self.game_id}/chat',
+                                      headers=LICHESS_HEADERS, json=body)
 
     def get_game_status(self):
         moves = self.board.fullmove_number
@@ -226,17 +201,159 @@ class ChessClient:
             return 'MID'
         
     def move_capture(self, move):
+        if self.board.is_en_passant(move):
+            return chess.piece_name(chess.PAWN)
         if self.board.is_capture(move):
             return chess.piece_name(self.board.piece_at(move.to_square).piece_type)
         return None
 
+    def stage_prompts(self, game_status):
+        if game_status == 'OPENING':
+            return (self.prefix, self.opening_prompt, self.body), (self.critic_preamble, self.critic_opening, self.critic_suffix)
+        elif game_status == 'MID':
+            return (self.prefix, self.mid_game_prompt, self.body), (self.critic_preamble, self.critic_suffix)
+        else:
+            return (self.prefix, self.end_game_prompt, self.body), (self.critic_preamble, self.critic_suffix)
+
+    def build_prompt(self, game_status, opp_move, captured_by_opp=None, proposed_move='', critique='', span=None):
+        static_parts, _ = self.stage_prompts(game_status)
+        return self.prompt_builder.proposer(static_parts, self.color, self.board, self.annotator.annotate(self.board),
+                                            opp_move, captured_by_opp, proposed_move, critique, span=span)
+
+    def build_critic_prompt(self, game_status, opp_move, proposed_move, captured_by_opp=None, span=None):
+        _, static_parts = self.stage_prompts(game_status)
+        move = chess.Move.from_uci(proposed_move)
+        captured_by_us = self.move_capture(move)
+        board_after = self.board.copy(stack=False)
+        board_after.push(move)
+        return self.prompt_builder.critic(static_parts, self.color, self.board, opp_move, proposed_move,
+                                          self.annotator.annotate(board_after), board_after, captured_by_us, captured_by_opp, span=span)
+
+    def parse_proposal(self, resp):
+        proposed_move = find_answer(resp, 'UCI')
+        try:
+            if proposed_move is not None and self.is_legal(proposed_move):
+                return proposed_move
+        except chess.InvalidMoveError:
+            pass
+        return None
+
+    def critic_approves(self, critique):
+        return find_answer(critique, 'STATUS') == 'SUCCESS'
+
+    def local_veto(self, proposed_move, round_number=0, deadline=None):
+        # A move the search sees dropping material is rejected without asking the critic
+        if self.searcher is None:
+            return None
+        # The veto runs two searches, together they get what find_forced gets
+        budget = None if deadline is None else min(self.searcher.budget, deadline.remaining() / 8)
+        with tracer.span('veto', game=self.game_id, round=round_number) as span:
+            veto = self.searcher.veto(self.board, chess.Move.from_uci(proposed_move), budget)
+            span['vetoed'] = veto is not None
+        if veto is not None:
+            log.info('Vetoed %s: %s', proposed_move, veto)
+        return veto
+
+    def fallback_move(self, deadline=None):
+        # Without the tactics option a shallow search still beats a random move
+        searcher = self.searcher if self.searcher is not None else TacticalSearcher(max_depth=2, budget=0.1)
+        budget = searcher.budget if deadline is None else min(searcher.budget, deadline.remaining() / 2)
+        result = searcher.search(self.board, budget)
+        if result is not None and result.move is not None:
+            log.warning('No usable proposal, playing the search move %s', result.move.uci())
+            return result.move.uci()
+        return self.random_move()
+
+    def random_move(self):
+        log.warning('All proposed moves were illegal, playing a random move')
+        all_legal_moves = list(self.board.legal_moves)
+        return random.choice(all_legal_moves).uci()
+
     # FILL IN WITH LOGIC TO SELECT WHICH MOVE TO DO
     # RETURN UCI STRING
-    def compute_next_move(self, opp_move, captured_by_opp=None):
-        game_state = self.get_game_state()
-        legal_moves = self.get_moves(self.color)
-        print(self.board.is_check())
-        print('ARE WE IN CHECK')
+    def compute_next_move(self, opp_move, captured_by_opp=None, cancel=None, deadline=None):
+        self.transcript = []
+        start = time.perf_counter()
+        with tracer.span('compute_next_move', game=self.game_id, ply=self.board.ply()) as span:
+            if self.pondering:
+                span['ponder'] = True
+            move = self.select_move(span, opp_move, captured_by_opp, cancel, deadline)
+            if 'tier' in span and not self.pondering:
+                # Forks thinking ahead mostly go unplayed and would skew the tuning stats
+                self.router.record(span['tier'], span['source'])
+        self.last_decision = dict(span, ms=(time.perf_counter() - start) * 1000, transcript=self.transcript)
+        return move
+
+    def select_move(self, span, opp_move, captured_by_opp=None, cancel=None, deadline=None):
+        if self.book is not None and self.get_game_status() == 'OPENING':
+            book_move = self.book.choose(self.board)
+            if book_move is not None:
+                log.info('Book move %s', book_move)
+                span['source'] = 'book'
+                return book_move
+
+        route = None
+        if self.router is not None:
+            route = self.router.route(self.board, self.annotator.annotate(self.board), self.get_game_status(), captured_by_opp)
+            span.update(route.features, tier=route.tier, score=route.score)
+            if route.move is not None:
+                log.info('Instant move %s: %s', route.move, route.reason)
+                span['source'] = 'instant'
+                return route.move
+
+        if self.scheduler.critical(deadline):
+            log.warning('%.1fs left for this move, not asking GPT', deadline.remaining())
+            span['source'] = 'clock'
+            return self.fallback_move(deadline)
+
+        if self.searcher is not None:
+            budget = None if deadline is None else min(self.searcher.budget, deadline.remaining() / 4)
+            with tracer.span('tactics', game=self.game_id, ply=self.board.ply()) as tactics_span:
+                forced, reason = self.searcher.find_forced(self.board, budget)
+                tactics_span['forced'] = forced is not None
+            if forced is not None:
+                log.info('Forced move %s: %s', forced.move.uci(), reason)
+                span['source'] = 'tactics'
+                return forced.move.uci()
+
+        if route is not None and route.tier == 'light':
+            light_move = self.compute_next_move_light(opp_move, captured_by_opp, deadline)
+            if light_move is not None:
+                span['source'] = 'light'
+                return light_move
+            span['escalated'] = True
+
+        if self.fan_out > 1:
+            span['source'] = 'parallel'
+            return self.compute_next_move_parallel(opp_move, captured_by_opp, cancel, deadline)
+        span['source'] = 'rounds'
+        return self.compute_next_move_rounds(opp_move, captured_by_opp, cancel, deadline)
+
+    def compute_next_move_light(self, opp_move, captured_by_opp=None, deadline=None):
+        # One proposal from the cheaper model and no critic, None hands the position to the full loop
+        game_status = self.get_game_status()
+        with tracer.span('prompt', game=self.game_id, role='proposer', round=0) as span:
+            prompt = self.build_prompt(game_status, opp_move, captured_by_opp, span=span)
+        try:
+            with tracer.span('light', game=self.game_id, tokens=span['tokens']) as light_span:
+                resp = self.light_agent.query(prompt, self.board, game_status, marker='UCI', deadline=deadline)
+                self.transcript.append({'role': 'light', 'round': 0, 'tokens': span['tokens'], 'prompt': prompt, 'response': resp})
+                proposed_move = self.parse_proposal(resp)
+                light_span['legal'] = proposed_move is not None
+        except DeadlineExceeded as e:
+            log.warning('Light model cut off: %s', e)
+            return None
+        except Exception as e:
+            log.warning('Light model failed: %r', e)
+            return None
+        if proposed_move is None or self.local_veto(proposed_move, deadline=deadline) is not None:
+            log.info('Light model proposal rejected, escalating')
+            return None
+        log.info('Selected move %s from the light model', proposed_move)
+        return proposed_move
+
+    def compute_next_move_rounds(self, opp_move, captured_by_opp=None, cancel=None, deadline=None):
+        log.debug('In check: %s', self.board.is_check())
         # self.get_board_image()
 
         game_status = self.get_game_status()
@@ -244,78 +361,161 @@ class ChessClient:
         critique = ''
         proposed_move = ''
         last_proposed_legal_move = None
-        for _ in range(3):
-            if game_status == 'OPENING':
-                stage_prompt = self.opening_prompt
-                critic_prompt = f'{self.critic_preamble}\n{self.critic_opening}'
-            elif game_status == 'MID':
-                stage_prompt = self.mid_game_prompt
-                critic_prompt = self.critic_preamble
-            else:
-                stage_prompt = self.end_game_prompt
-                critic_prompt = self.critic_preamble
-
-            prompt = f'{self.color_prompt}{self.prefix}{stage_prompt}{self.body}\nGAME STATE:\n{game_state}\nLEGAL MOVES:\n{legal_moves}\nVISUAL GAME STATE:\n{self.board}\nOPPONENT MOVE:\n{opp_move}\n'
-            if captured_by_opp:
-                prompt += f'OPPONENT MOVE RESULTED IN CAPTURE OF FOLLOWING PIECE:\n{captured_by_opp}'
-            if critique != '' and proposed_move != '':
-                prompt += f'PREVIOUS PROPOSED MOVE:\n{proposed_move}\nCRITIQUE ABOUT PREVIOUS PROPOSED MOVE:\n{critique}\n'
-            print(prompt)
-            resp = self.agent.query(prompt)
-            proposed_move = resp.split("UCI: ")[-1].strip('."')
-            print('GPT RESPONSE:')
-            print(resp)
-            print('--------------------------')
+        for round_number in range(self.scheduler.max_rounds):
+            if cancel is not None and cancel.is_set():
+                return last_proposed_legal_move
+            if self.scheduler.rounds_left(deadline, round_number) == 0:
+                log.info('No time for round %d, %.1fs left', round_number, deadline.remaining())
+                break
+
+            with tracer.span('prompt', game=self.game_id, role='proposer', round=round_number) as span:
+                prompt = self.build_prompt(game_status, opp_move, captured_by_opp, proposed_move, critique, span=span)
+            log.debug('Proposer prompt:\n%s', prompt)
             try:
-                move = chess.Move.from_uci(proposed_move)
-                if not self.is_legal(proposed_move):
-                    print('ILLEGAL MOVE')
-                    critique = f'The proposed move is illegal! STATUS: FAIL'
-                    continue
-            except chess.InvalidMoveError:
+                with tracer.span('proposer', game=self.game_id, round=round_number, tokens=span['tokens']):
+                    resp = self.agent.query(prompt, self.board, game_status, marker='UCI', deadline=deadline)
+                self.transcript.append({'role': 'proposer', 'round': round_number, 'tokens': span['tokens'], 'prompt': prompt, 'response': resp})
+            except DeadlineExceeded as e:
+                log.warning('Proposer cut off in round %d: %s', round_number, e)
+                break
+            except Exception as e:
+                # Still failing after the transport's retries, the next round may get through
+                log.warning('Proposer failed in round %d: %r', round_number, e)
+                continue
+            log.debug('GPT response:\n%s', resp)
+            with tracer.span('legality', game=self.game_id, round=round_number) as span:
+                proposed_move = self.parse_proposal(resp)
+                span['legal'] = proposed_move is not None
+            if proposed_move is None:
+                log.info('Illegal move proposed in round %d', round_number)
+                proposed_move = find_answer(resp, 'UCI') or resp.split("UCI: ")[-1].strip('."')
                 critique = f'The proposed move is illegal! STATUS: FAIL'
                 continue
-            captured_by_us = self.move_capture(move)
-
-            self.board.push(move)
-            opp_legal_moves = self.get_moves(
-                'black' if self.color == 'white' else 'white')
 
-            attacks = self.get_attacks(opp_color=self.color == 'black')
-
-            self.board.pop()
+            veto = self.local_veto(proposed_move, round_number, deadline)
+            if veto is not None:
+                critique = f'{veto} STATUS: FAIL'
+                continue
 
-            critic_prompt = f'{critic_prompt}\nGAME STATE:\n{game_state}\nOUR LEGAL MOVES:\n{legal_moves}\nVISUAL GAME STATE:\n{self.board}\nOPPONENT MOVE:\n{opp_move}\nOUR PROPOSED MOVE:\n{proposed_move}\nOPPONENT LEGAL MOVES AFTER OUR PROPOSED MOVE:\n{opp_legal_moves}'
-            if captured_by_opp:
-                prompt += f'\nOPPONENT MOVE RESULTED IN CAPTURE OF FOLLOWING PIECE:\n{captured_by_opp}'
-            if captured_by_us:
-                critic_prompt += f'\nOPPONENT PIECE CAPTURED AFTER OUR PROPOSED MOVE:\n{captured_by_us}'
-            critic_prompt += f'\n{self.critic_suffix}'
-            print(critic_prompt)
-            if not self.is_legal(proposed_move):
-                critique = f'The proposed move is illegal! STATUS: FAIL'
-            else:
-                critique = self.critic_agent.query(critic_prompt)
-                last_proposed_legal_move = proposed_move
-            print('CRITIQUE')
-            print(critique)
-            if critique.split("STATUS: ")[-1].strip('."') == 'SUCCESS':
+            with tracer.span('prompt', game=self.game_id, role='critic', round=round_number) as span:
+                critic_prompt = self.build_critic_prompt(game_status, opp_move, proposed_move, captured_by_opp, span=span)
+            log.debug('Critic prompt:\n%s', critic_prompt)
+            # A legal, unvetoed proposal is the best move so far even if the critic runs out of time
+            last_proposed_legal_move = proposed_move
+            try:
+                with tracer.span('critic', game=self.game_id, round=round_number, tokens=span['tokens']):
+                    critique = self.critic_agent.query(critic_prompt, self.board, game_status, marker='STATUS', deadline=deadline)
+                self.transcript.append({'role': 'critic', 'round': round_number, 'tokens': span['tokens'], 'prompt': critic_prompt, 'response': critique})
+            except DeadlineExceeded as e:
+                log.warning('Critic cut off in round %d: %s', round_number, e)
+                break
+            except Exception as e:
+                log.warning('Critic failed in round %d, keeping %s: %r', round_number, proposed_move, e)
+                break
+            log.debug('Critique:\n%s', critique)
+            if self.critic_approves(critique):
                 break
         if last_proposed_legal_move is None:
-            print("ALL PROPOSED MOVES WERE ILLEGAL. GPT IS VERY STUPID!")
-            print("ALL PROPOSED MOVES WERE ILLEGAL. GPT IS VERY STUPID!")
-            print("ALL PROPOSED MOVES WERE ILLEGAL. GPT IS VERY STUPID!")
-            all_legal_moves = list(self.board.legal_moves)
-            last_proposed_legal_move = random.choice(all_legal_moves).uci()
-        print('DONE SELECTING MOVE!!')
+            last_proposed_legal_move = self.fallback_move(deadline)
+        log.info('Selected move %s', last_proposed_legal_move)
         return last_proposed_legal_move
 
-        # all_legal_moves = list(self.board.legal_moves)
-        # return random.choice(all_legal_moves).uci()
-
-    def make_move(self, uci_string):
-        requests.post(
-            f'{LICHESS_BASE_URL}/api/bot/game/{self.game_id}/move/{uci_string}', headers=LICHESS_HEADERS)
+    def timed_query(self, transcript, agent, name, prompt, position, game_status, sample=0, marker=None, deadline=None, **fields):
+        # transcript is the list of the move that asked, a straggler that
+        # finishes after the move is played must not land in the next one's
+        with tracer.span(name, game=self.game_id, sample=sample, **fields):
+            resp = agent.query(prompt, position, game_status, sample, marker=marker, deadline=deadline)
+        transcript.append({'role': name, 'sample': sample, 'tokens': fields.get('tokens'), 'prompt': prompt, 'response': resp})
+        return resp
+
+    def compute_next_move_parallel(self, opp_move, captured_by_opp=None, cancel=None, deadline=None):
+        # One round of fan_out proposers and one round of critics, both in
+        # parallel, so a move costs about two round trips however many samples.
+        budget = self.deadline if deadline is None else min(self.deadline, deadline.remaining())
+        deadline = Deadline(budget, self.scheduler.clock)
+        game_status = self.get_game_status()
+        with tracer.span('prompt', game=self.game_id, role='proposer', round=0) as span:
+            prompt = self.build_prompt(game_status, opp_move, captured_by_opp, span=span)
+        log.debug('Proposer prompt:\n%s', prompt)
+
+        position = self.board.copy(stack=False)
+        pool = self.get_pool()
+        proposals = [pool.submit(self.timed_query, self.transcript, self.agent, 'proposer', prompt, position, game_status, sample, 'UCI', Deadline(budget / 2, self.scheduler.clock), tokens=span['tokens'])
+                     for sample in range(self.fan_out)]
+        # Stragglers only get half the budget so the critics still have time to run
+        done, _ = wait(proposals, timeout=budget / 2)
+
+        votes = Counter()
+        for future in done:
+            if future.cancelled():
+                # Dropped by close_pool when a ponder job is cancelled
+                continue
+            if future.exception() is not None:
+                log.warning('Proposer failed: %r', future.exception())
+                continue
+            proposed_move = self.parse_proposal(future.result())
+            if proposed_move is not None:
+                votes[proposed_move] += 1
+        for future in proposals:
+            future.cancel()
+        log.info('Proposals: %s', dict(votes))
+        for proposed_move in list(votes):
+            if self.local_veto(proposed_move, deadline=deadline) is not None:
+                del votes[proposed_move]
+        if not votes:
+            return self.fallback_move(deadline)
+        if cancel is not None and cancel.is_set():
+            return votes.most_common(1)[0][0]
+
+        critiques = {}
+        for proposed_move in votes:
+            with tracer.span('prompt', game=self.game_id, role='critic', round=0) as span:
+                critic_prompt = self.build_critic_prompt(game_status, opp_move, proposed_move, captured_by_opp, span=span)
+            critiques[pool.submit(self.timed_query, self.transcript, self.critic_agent, 'critic', critic_prompt, position, game_status, 0, 'STATUS', deadline, tokens=span['tokens'])] = proposed_move
+        done, _ = wait(critiques, timeout=deadline.remaining())
+
+        approved = set()
+        rejected = set()
+        for future in done:
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                log.warning('Critic failed for %s: %r', critiques[future], future.exception())
+            elif self.critic_approves(future.result()):
+                approved.add(critiques[future])
+            else:
+                rejected.add(critiques[future])
+        for future in critiques:
+            future.cancel()
+        log.info('Approved: %s, rejected: %s', approved, rejected)
+
+        # Prefer moves the critic approved, then ones it gave no verdict on,
+        # break ties by how many proposers agreed
+        candidates = [move for move in votes if move not in rejected]
+        if not candidates:
+            log.info('The critic rejected every proposal')
+            return self.fallback_move(deadline)
+        ranked = sorted(candidates, key=lambda move: (move in approved, votes[move]), reverse=True)
+        return ranked[0]
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=2 * self.fan_out)
+        return self.pool
+
+    def close_pool(self):
+        # Drops queries still queued, the ones already sent finish on their own.
+        # A closed pool is kept so a late submit fails instead of starting another.
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def make_move(self, uci_string, deadline=None):
+        # deadline is our clock running out, retries that would outlast it give up
+        sent = time.perf_counter()
+        future = self.send_queue.submit(
+            'POST', f'{self.base_url}/api/bot/game/{self.game_id}/move/{uci_string}', headers=LICHESS_HEADERS, deadline=deadline)
+        future.add_done_callback(lambda _: tracer.record('make_move', (time.perf_counter() - sent) * 1000, game=self.game_id, move=uci_string))
+        return future
 
     def get_board_image(self):
         svg = chess.svg.board(self.board)
@@ -323,60 +523,226 @@ class ChessClient:
         outputfile.write(svg)
         outputfile.close()
 
-    def play_game(self, start=False):
-        s = requests.Session()
-        with s.get(f'{LICHESS_BASE_URL}/api/bot/game/stream/{self.game_id}', headers=LICHESS_HEADERS, stream=True) as resp:
-            print('here')
+    def on_game_full(self, game):
+        # First event of every (re)connect, carries the start position and the whole game so far
+        if self.color is None:
+            white = game.get('white', {}).get('id')
+            self.color = 'white' if white == LICHESS_USERNAME.lower() else 'black'
+        initial_fen = game.get('initialFen', 'startpos')
+        initial_fen = chess.STARTING_FEN if initial_fen == 'startpos' else initial_fen
+        if initial_fen != self.initial_fen:
+            self.initial_fen = initial_fen
+            self.moves_text = None
+        return game['state']
+
+    def sync_moves(self, moves):
+        # Brings the board in line with the server's move list and returns the
+        # new moves with what each captured. Usually only the last move or two
+        # are new, the board is only rebuilt when the two histories disagree.
+        known = self.moves_text
+        if moves == known:
+            # Includes the server echoing our own move back
+            self.pending_move = None
+            return []
+        if known is not None and moves.startswith(known) and (not known or moves[len(known)] == ' '):
+            new_moves = moves[len(known):].split()
+            self.pending_move = None
+        elif known is not None and known.startswith(moves) and (not moves or known[len(moves)] == ' '):
+            dropped = known[len(moves):].split()
+            if self.pending_move is not None and dropped == [self.pending_move[0]] and not self.move_rejected(self.pending_move[1]):
+                # Only our own move is missing and it is still on its way, the event predates it
+                return []
+            # The server is behind us, a move of ours it never took or a takeback
+            for _ in dropped:
+                self.board.pop()
+            self.store.drop_plies(self.game_id, self.board.ply())
+            self.moves_text = moves
+            self.pending_move = None
+            if self.ponderer is not None:
+                self.ponderer.cancel()
+            return []
+        else:
+            log.warning('Board out of sync with game %s, rebuilding it', self.game_id)
+            self.board = chess.Board(self.initial_fen)
+            # Plies up to where the histories part are kept with their transcripts.
+            # A new start position (known is None) replaces all of them.
+            common = 0
+            if known is not None:
+                for old_move, new_move in zip(known.split(), moves.split()):
+                    if old_move != new_move:
+                        break
+                    common += 1
+            self.store.drop_plies(self.game_id, self.board.ply() + common if known is not None else 0)
+            self.pending_move = None
+            new_moves = moves.split()
+            if self.ponderer is not None:
+                self.ponderer.cancel()
+
+        applied = []
+        for uci in new_moves:
+            move = chess.Move.from_uci(uci)
+            applied.append((uci, self.move_capture(move)))
+            side = 'us' if self.board.turn == (self.color == 'white') else 'them'
+            self.store.record_ply(self.game_id, self.board, uci, side)
+            self.board.push(move)
+        self.moves_text = moves
+        return applied
+
+    def move_rejected(self, future):
+        if not future.done():
+            return False
+        return future.exception() is not None or future.result().status_code >= 400
+
+    def on_game_state(self, state):
+        new_moves = self.sync_moves(state['moves'])
+        our_turn = self.board.turn == (self.color == 'white')
+        if not our_turn or self.board.is_game_over():
+            return None
+        # The clock starts running for us as soon as this event is sent
+        deadline = self.scheduler.deadline(state, self.color)
+
+        if not new_moves:
+            # Start of the game, or a reconnect that finds the move still ours to make
+            opp_move = self.board.peek().uci() if self.board.move_stack else ''
+            return self.compute_next_move(opp_move, deadline=deadline)
+
+        # Keeping track of what move opponent made
+        opp_move, cap = new_moves[-1]
+
+        # Compute what move to make based on current game state and available moves
+        if self.ponderer is not None and len(new_moves) == 1:
+            start = time.perf_counter()
+            with tracer.span('compute_next_move', game=self.game_id, ply=self.board.ply(), source='ponder') as span:
+                # Waiting on a job that never finishes must still leave time to think afresh
+                bot_move = self.ponderer.take(opp_move, None if deadline is None else deadline.remaining() * self.ponderer.wait_share)
+                span['hit'] = bot_move is not None and self.is_legal(bot_move)
+            if span['hit']:
+                log.info('Ponder hit: %s -> %s', opp_move, bot_move)
+                self.last_decision = dict(span, ms=(time.perf_counter() - start) * 1000, transcript=[])
+                return bot_move
+        elif self.ponderer is not None:
+            # Pondering assumed we saw every move, after a gap none of it applies
+            self.ponderer.cancel()
+        return self.compute_next_move(opp_move, cap, deadline=deadline)
+
+    def fork(self):
+        # Same agents and prompts, private board, used to think ahead off the main line
+        forked = copy.copy(self)
+        forked.board = self.board.copy()
+        forked.ponderer = None
+        forked.pondering = True
+        # Its own workers, or its proposers and critics hold up the real move's
+        forked.pool = None
+        return forked
+
+    def push_bot_move(self, bot_move):
+        decision = self.last_decision or {}
+        self.last_decision = None
+        self.store.record_ply(self.game_id, self.board, bot_move, 'us', decision.get('source'), decision.get('tier'),
+                              self.get_game_status(), decision.get('ms'), decision.get('transcript'))
+        self.board.push(chess.Move.from_uci(bot_move))
+        if self.moves_text is not None:
+            self.moves_text = f'{self.moves_text} {bot_move}' if self.moves_text else bot_move
+        if self.ponderer is not None:
+            self.ponderer.start()
+
+    def resume(self, game_id, color, fen=None):
+        # Picks up a game started by an earlier process, the first gameFull fills in the moves
+        self.game_id = game_id
+        self.color = color
+        self.fen = fen
+        self.board = chess.Board(fen) if fen is not None else chess.Board()
+        self.initial_fen = self.board.fen()
+        self.moves_text = ''
+        self.pending_move = None
+
+    def stream_game(self):
+        # Follows the game until it ends, returns None if the connection drops first
+        self.stream_events = 0
+        with self.transport.get(f'{self.base_url}/api/bot/game/stream/{self.game_id}', headers=LICHESS_HEADERS,
+                                stream=True, timeout=(5, 60)) as resp:
+            if resp.status_code >= 400:
+                log.error('Cannot stream game %s: %d %s', self.game_id, resp.status_code, resp.text)
+                return f'http {resp.status_code}'
             for line in resp.iter_lines():
-                if line:
-                    json_resp = json.loads(line)
-                    print(json_resp)
-                    if 'state' in json_resp:
-                        json_resp = json_resp['state']
-                    if json_resp['type'] == 'gameState':
-                        if json_resp['status'] != 'started':
-                            resp.close()
-                            print('Opponent resigned.')
-                            break
-
-                        if len(json_resp['moves'].split()) % 2 == 1 and self.color == 'white' and not start:
-                            continue
-
-                        if len(json_resp['moves'].split()) % 2 == 0 and self.color == 'black' and not start:
-                            continue
-
-                        if start:
-                            bot_move = self.compute_next_move('')
-                            self.make_move(bot_move)
-                            self.board.push(chess.Move.from_uci(bot_move))
-                            continue
-                        # Keeping track of what move opponent made
-                        new_position = json_resp['moves'].split()[-1]
-                        opp_move = chess.Move.from_uci(new_position)
-                        # cap = None
-                        cap = self.move_capture(opp_move)
-                        # if self.board.is_capture(opp_move):
-                        #     cap = self.board.piece_at(
-                        #         opp_move.to_square).piece_type
-                        self.board.push(opp_move)
-
-                        # Compute what move to make based on current game state and available moves
-                        bot_move = self.compute_next_move(new_position, cap)
-                        self.make_move(bot_move)
-                        self.board.push(chess.Move.from_uci(bot_move))
-                        # print(self.board)
-                        print('Waiting for opponent move...')
-
-                    elif json_resp['type'] == 'gameFull':
-                        if self.color == 'white':
-                            bot_move = self.compute_next_move()
-                            self.make_move(bot_move)
-                            self.board.push(chess.Move.from_uci(bot_move))
-                    
-
-        print('Exiting Game')
-
+                # Checked on keepalive lines too: Lichess sends no event for a move it
+                # never took, the resync after reconnecting takes it back and plays again
+                if self.pending_move is not None and self.move_rejected(self.pending_move[1]):
+                    log.error('Move %s was not accepted in game %s, resyncing', self.pending_move[0], self.game_id)
+                    self.pending_move = None
+                    return None
+                if not line:
+                    continue
+                json_resp = json.loads(line)
+                log.debug('Game event: %s', json_resp)
+                self.stream_events += 1
+                if json_resp.get('type') == 'gameFull':
+                    json_resp = self.on_game_full(json_resp)
+                if json_resp.get('type') != 'gameState':
+                    continue
+                if json_resp['status'] != 'started':
+                    self.winner = json_resp.get('winner')
+                    return json_resp['status']
+
+                # Taken before thinking, our clock runs from when the event was sent
+                flag = self.scheduler.flag_deadline(json_resp, self.color)
+                bot_move = self.on_game_state(json_resp)
+                if bot_move is None:
+                    continue
+                self.pending_move = (bot_move, self.make_move(bot_move, flag))
+                self.push_bot_move(bot_move)
+                log.debug('Waiting for opponent move...')
+        return None
 
-client = ChessClient()
-client.start_challenge('ai')
-client.play_game()
+    def play_game(self):
+        self.sessions.add(self.game_id, self.color, self.fen)
+        self.store.start_game(self.game_id, self.color, self.initial_fen)
+        failures = 0
+        while True:
+            try:
+                status = self.stream_game()
+            except requests.RequestException as e:
+                log.warning('Game stream for %s dropped: %r', self.game_id, e)
+                status = None
+            if status is not None:
+                break
+            failures = 1 if self.stream_events else failures + 1
+            wait = self.transport.delay(min(failures - 1, 10))
+            log.info('Reconnecting to game %s in %.1fs', self.game_id, wait)
+            # Moves still in the send queue must land first or the resync would see our turn again
+            self.send_queue.flush()
+            time.sleep(wait)
+        log.info('Game over: %s', status)
+        self.store.finish_game(self.game_id, self.color, status, self.winner)
+        self.sessions.remove(self.game_id)
+        if self.ponderer is not None:
+            self.ponderer.shutdown()
+        self.close_pool()
+        self.send_queue.close()
+        self.store.flush()
+        self.cache.flush()
+        log.info('Exiting game %s', self.game_id)
+        log.info('GPT cache: %s', self.cache.stats())
+        log.info('Prompt tokens: %s', self.prompt_builder.stats())
+        if self.router is not None:
+            log.info('Routing: %s', self.router.stats())
+        tracer.flush()
+        tracer.write_prometheus(METRICS_PATH)
+        return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play one Lichess game, resuming an unfinished one first.')
+    parser.add_argument('--ponder', action='store_true', help='precompute replies to likely opponent moves (extra GPT calls)')
+    parser.add_argument('--route', action='store_true', help='send quiet positions to the light model')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    client = ChessClient(ponder=args.ponder, tactics=True, route=args.route, book=OPENING_BOOK_PATH if os.path.exists(OPENING_BOOK_PATH) else None)
+    ongoing = client.sessions.games()
+    if ongoing:
+        game_id, game = next(iter(ongoing.items()))
+        log.info('Resuming game %s', game_id)
+        client.resume(game_id, game['color'], game['fen'])
+    else:
+        client.start_challenge('ai')
+    client.play_game()
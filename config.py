@@ -1,4 +1,13 @@
-from secret import LICHESS_API_KEY, GPT_API_KEY, GPT_ORG_ID
+import os
+
+try:
+    from secret import LICHESS_API_KEY, LICHESS_USERNAME, GPT_API_KEY, GPT_ORG_ID
+except ImportError:
+    # No secret.py, e.g. a benchmark against the local stand-ins
+    LICHESS_API_KEY = os.environ.get('LICHESS_API_KEY', '')
+    LICHESS_USERNAME = os.environ.get('LICHESS_USERNAME', 'bot')
+    GPT_API_KEY = os.environ.get('GPT_API_KEY', '')
+    GPT_ORG_ID = os.environ.get('GPT_ORG_ID', '')
 
 LICHESS_BASE_URL = 'https://lichess.org'
 LICHESS_HEADERS = {"Authorization" : f"Bearer {LICHESS_API_KEY}"}
@@ -9,3 +18,9 @@ GPT_HEADERS = {
     "Content-Type" : "application/json", 
     "OpenAI-Organization" : GPT_ORG_ID
 }
+
+OPENING_BOOK_PATH = 'book.bin'
+TRACE_PATH = 'traces.jsonl'
+METRICS_PATH = 'metrics.prom'
+GAMES_PATH = 'games.json'
+GAME_STORE_PATH = 'games.sqlite'
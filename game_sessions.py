@@ -0,0 +1,43 @@
+import json
+import os
+import threading
+
+from config import GAMES_PATH
+from metrics import log
+
+
+class GameSessions:
+    # Games in progress, kept on disk so a restarted bot picks them back up.
+    # The move list itself is not stored, the gameFull event on reconnect has it.
+    def __init__(self, path=GAMES_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def games(self):
+        try:
+            with open(self.path) as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            log.warning('Ignoring unreadable %s: %r', self.path, e)
+            return {}
+
+    def add(self, game_id, color, fen=None):
+        with self.lock:
+            games = self.games()
+            games[game_id] = {'color': color, 'fen': fen}
+            self.write(games)
+
+    def remove(self, game_id):
+        with self.lock:
+            games = self.games()
+            if games.pop(game_id, None) is not None:
+                self.write(games)
+
+    def write(self, games):
+        # Replace the file in one step so a crash never leaves half a file behind
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as out:
+            json.dump(games, out)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,219 @@
+import argparse
+import json
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+import chess
+import chess.polyglot
+
+from config import GAME_STORE_PATH
+
+
+DRAW_STATUSES = {'draw', 'stalemate'}
+PLY_COLUMNS = ['game_id', 'ply', 'zobrist', 'fen', 'move', 'side', 'source', 'tier', 'phase', 'ms', 'tokens', 'created']
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS games ('
+    'game_id TEXT PRIMARY KEY, color TEXT, initial_fen TEXT, started REAL, '
+    'finished REAL, status TEXT, winner TEXT, outcome TEXT)',
+    'CREATE TABLE IF NOT EXISTS plies ('
+    'game_id TEXT, ply INTEGER, zobrist TEXT, fen TEXT, move TEXT, side TEXT, source TEXT, tier TEXT, '
+    'phase TEXT, ms REAL, tokens INTEGER, created REAL, transcript BLOB, PRIMARY KEY (game_id, ply))',
+    'CREATE INDEX IF NOT EXISTS plies_zobrist ON plies (zobrist)',
+    'CREATE INDEX IF NOT EXISTS games_outcome ON games (outcome)',
+]
+INSERT_PLY = 'INSERT OR IGNORE INTO plies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+
+def game_outcome(color, status, winner=None):
+    if winner is not None:
+        return 'win' if winner == color else 'loss'
+    return 'draw' if status in DRAW_STATUSES else status
+
+
+def pack_transcript(transcript):
+    # Prompts repeat their static prefix every round, so they compress very well
+    if not transcript:
+        return None
+    return zlib.compress(json.dumps(transcript).encode('utf-8'))
+
+
+def unpack_transcript(blob):
+    if blob is None:
+        return []
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+class GameStore:
+    # Every ply we see and every game result, appended to SQLite from a
+    # background thread in batched transactions. A ply is written once, a
+    # second write of it (after a board rebuild) is ignored, plies the server
+    # never took or took back are dropped, and a game row only ever gets its
+    # result filled in.
+    def __init__(self, path=GAME_STORE_PATH, batch_size=256, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start_game(self, game_id, color, initial_fen):
+        self.put('INSERT OR IGNORE INTO games (game_id, color, initial_fen, started) VALUES (?, ?, ?, ?)',
+                 (game_id, color, initial_fen, time.time()))
+
+    def record_ply(self, game_id, board, move, side, source=None, tier=None, phase=None, ms=None, transcript=None):
+        # board is the position before move
+        tokens = sum(entry.get('tokens') or 0 for entry in transcript) if transcript else None
+        # The transcript is compressed by the writer thread
+        self.put(INSERT_PLY, (game_id, board.ply(), f'{chess.polyglot.zobrist_hash(board):016x}', board.fen(), move, side,
+                              source, tier, phase, ms, tokens, time.time(), transcript))
+
+    def drop_plies(self, game_id, ply):
+        # Queued behind the plies it undoes, so it cannot overtake them
+        self.put('DELETE FROM plies WHERE game_id = ? AND ply >= ?', (game_id, ply))
+
+    def finish_game(self, game_id, color, status, winner=None):
+        self.put('UPDATE games SET finished = ?, status = ?, winner = ?, outcome = ? WHERE game_id = ? AND finished IS NULL',
+                 (time.time(), status, winner, game_outcome(color, status, winner), game_id))
+
+    def put(self, sql, params):
+        self.queue.put((sql, params))
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='game-store', daemon=True)
+                self.thread.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            db.execute(statement)
+        db.commit()
+        return db
+
+    def run(self):
+        db = self.connect()
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+            stop = None in batch
+            with db:
+                for item in batch:
+                    if item is None:
+                        continue
+                    sql, params = item
+                    if sql is INSERT_PLY:
+                        params = params[:-1] + (pack_transcript(params[-1]),)
+                    db.execute(sql, params)
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                db.close()
+                return
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def positions(self, outcome=None, zobrist=None, side=None, limit=None):
+        # Plies joined with their game's outcome, e.g. every position we reached in games we lost
+        self.flush()
+        clauses = []
+        params = []
+        if outcome is not None:
+            clauses.append('games.outcome = ?')
+            params.append(outcome)
+        if zobrist is not None:
+            clauses.append('plies.zobrist = ?')
+            params.append(zobrist)
+        if side is not None:
+            clauses.append('plies.side = ?')
+            params.append(side)
+        sql = ('SELECT ' + ', '.join(f'plies.{column}' for column in PLY_COLUMNS) +
+               ', games.outcome, plies.transcript FROM plies JOIN games USING (game_id)')
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY plies.game_id, plies.ply'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        db = self.connect()
+        try:
+            for row in db.execute(sql, params):
+                record = dict(zip(PLY_COLUMNS + ['outcome'], row[:-1]))
+                record['transcript'] = row[-1]
+                yield record
+        finally:
+            db.close()
+
+    def export(self, out, transcripts=False, **filters):
+        # One JSON object per ply, streamed straight from the cursor
+        count = 0
+        for record in self.positions(**filters):
+            blob = record.pop('transcript')
+            if transcripts:
+                record['transcript'] = unpack_transcript(blob)
+            out.write(json.dumps(record) + '\n')
+            count += 1
+        return count
+
+    def stats(self):
+        self.flush()
+        db = self.connect()
+        try:
+            games = dict(db.execute('SELECT COALESCE(outcome, \'ongoing\'), COUNT(*) FROM games GROUP BY 1').fetchall())
+            plies, tokens = db.execute('SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM plies').fetchone()
+        finally:
+            db.close()
+        return {'games': games, 'plies': plies, 'tokens': tokens}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the game record store.')
+    parser.add_argument('--db', default=GAME_STORE_PATH)
+    sub = parser.add_subparsers(dest='command', required=True)
+    export = sub.add_parser('export', help='write plies as JSON lines')
+    export.add_argument('-o', '--output', default='-')
+    export.add_argument('--transcripts', action='store_true', help='include prompts and responses')
+    for command in (export, sub.add_parser('positions', help='print FEN and move for matching plies')):
+        command.add_argument('--outcome', default=None, help='win, loss, draw or a Lichess status')
+        command.add_argument('--fen', default=None, help='only plies from this position')
+        command.add_argument('--side', choices=['us', 'them'], default=None)
+        command.add_argument('--limit', type=int, default=None)
+    sub.add_parser('stats', help='games by outcome, ply and token totals')
+    args = parser.parse_args()
+
+    store = GameStore(args.db)
+    if args.command == 'stats':
+        print(json.dumps(store.stats(), indent=2))
+    else:
+        zobrist = f'{chess.polyglot.zobrist_hash(chess.Board(args.fen)):016x}' if args.fen else None
+        filters = {'outcome': args.outcome, 'zobrist': zobrist, 'side': args.side, 'limit': args.limit}
+        if args.command == 'export':
+            out = sys.stdout if args.output == '-' else open(args.output, 'w')
+            count = store.export(out, args.transcripts, **filters)
+            if out is not sys.stdout:
+                out.close()
+            print(f'Exported {count} plies', file=sys.stderr)
+        else:
+            for record in store.positions(**filters):
+                print(record['fen'], record['move'], record['source'] or '', record['outcome'] or '')
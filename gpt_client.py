@@ -1,21 +1,118 @@
 from config import GPT_BASE_URL, GPT_HEADERS
-import requests
+import json
+import re
+import time
+from transport import transport
+from metrics import log
+
+# Final answer markers the prompts ask for, e.g. 'UCI: e2e4' and 'STATUS: SUCCESS'
+ANSWER_PATTERNS = {
+    'UCI': re.compile(r'UCI:\s*[<"\'`*]*([a-h][1-8][a-h][1-8][qrbnQRBN]?)(?![A-Za-z0-9])'),
+    'STATUS': re.compile(r'STATUS:\s*[<"\'`*]*(SUCCESS|FAIL)(?![A-Za-z0-9])'),
+}
+
+
+def find_answer(text, marker):
+    # The prompts ask the model to end with the marker, so the last one is the
+    # answer. Earlier ones are ideas it went on to drop.
+    matches = list(ANSWER_PATTERNS[marker].finditer(text))
+    if not matches:
+        return None
+    answer = matches[-1].group(1)
+    return answer.lower() if marker == 'UCI' else answer
+
+
+def sse_chunk(line):
+    # One server-sent event line as (text, finished). The message is finished
+    # at its finish_reason, whatever follows (usage, [DONE]) is not needed.
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    line = line.strip()
+    if not line.startswith('data:'):
+        return '', False
+    data = line[5:].strip()
+    if data == '[DONE]':
+        return '', True
+    chunk = json.loads(data)
+    if 'error' in chunk:
+        log.error('Streamed completion error: %s', chunk)
+        raise Exception('Error in streamed completion')
+    choices = chunk.get('choices', [])
+    text = ''.join(choice.get('delta', {}).get('content') or '' for choice in choices)
+    return text, any(choice.get('finish_reason') is not None for choice in choices)
+
+
+def sse_deltas(lines):
+    for line in lines:
+        text, finished = sse_chunk(line)
+        if text:
+            yield text
+        if finished:
+            return
+
 
 class GPTAgent:
-    def __init__(self):
-        print('init')
+    def __init__(self, role='proposer', cache=None, base_url=GPT_BASE_URL, stream=False, model='gpt-4'):
+        self.role = role
+        self.model = model
+        self.cache = cache
+        self.base_url = base_url
+        self.stream = stream
+        self.transport = transport
+        # Called with the seconds each completion took, cache hits excluded
+        self.on_latency = None
+
+    def query(self, prompt, board=None, phase=None, sample=0, marker=None, on_answer=None, deadline=None):
+        key = None
+        if self.cache is not None and board is not None:
+            # Answers from different models must not be served for each other
+            key = self.cache.make_key(board, phase, f'{self.role}:{self.model}', prompt, sample)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        if deadline is not None:
+            deadline.check()
 
-    def query(self, prompt):
         body = {
-            "model": "gpt-4",
+            "model": self.model,
             "messages": [{"role": "user", "content": prompt}],
             "temperature": 0.7
         }
-        r = requests.post(f'{GPT_BASE_URL}/v1/chat/completions', headers=GPT_HEADERS, json=body)
-        if 'error' in r.json():
-            print(r.json())
-            raise Exception('Error in game creation')
-        return r.json()['choices'][0]['message']['content']
+        start = time.monotonic()
+        try:
+            if self.stream and marker is not None:
+                body['stream'] = True
+                content, answer = self.stream_completion(body, marker, deadline)
+                if answer is not None and on_answer is not None:
+                    on_answer(answer)
+            else:
+                resp = self.post_completion(body, deadline)
+                if 'error' in resp:
+                    log.error('Completion error: %s', resp)
+                    raise Exception('Error in game creation')
+                content = resp['choices'][0]['message']['content']
+        finally:
+            if self.on_latency is not None:
+                self.on_latency(time.monotonic() - start)
+        if key is not None:
+            self.cache.put(key, content)
+        return content
+
+    def post_completion(self, body, deadline=None):
+        r = self.transport.post(f'{self.base_url}/v1/chat/completions', headers=GPT_HEADERS, json=body, deadline=deadline)
+        return r.json()
+
+    def stream_completion(self, body, marker, deadline=None):
+        # Reads until the message is finished and takes the answer from the
+        # whole text, like a complete response. Running out of move budget
+        # mid-stream closes the response and aborts the generation.
+        text = ''
+        with self.transport.post(f'{self.base_url}/v1/chat/completions', headers=GPT_HEADERS, json=body, stream=True, deadline=deadline) as r:
+            for content in sse_deltas(r.iter_lines()):
+                if deadline is not None:
+                    deadline.check()
+                text += content
+        return text, find_answer(text, marker)
 
 # agent = GPTAgent()
-# agent.query('What does 2 + 2 equal?')
\ No newline at end of file
+# agent.query('What does 2 + 2 equal?')
@@ -0,0 +1,113 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from config import TRACE_PATH
+
+
+log = logging.getLogger('stockgpt')
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class Tracer:
+    # Spans are handed to a background thread that batches them into a JSONL
+    # file, the hot path only pays for a queue put.
+    def __init__(self, path=TRACE_PATH, window=2048, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.durations = defaultdict(lambda: deque(maxlen=window))
+        self.counts = defaultdict(int)
+        self.sums = defaultdict(float)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @contextmanager
+    def span(self, name, **fields):
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000, **fields)
+
+    def record(self, name, duration_ms, **fields):
+        with self.lock:
+            self.durations[name].append(duration_ms)
+            self.counts[name] += 1
+            self.sums[name] += duration_ms
+        if self.path is None:
+            return
+        fields.update(span=name, ms=round(duration_ms, 3), ts=time.time(), thread=threading.current_thread().name)
+        self.queue.put(fields)
+        if self.thread is None:
+            self.start()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='trace-writer', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        with open(self.path, 'a') as out:
+            while True:
+                batch = [self.queue.get()]
+                try:
+                    while len(batch) < 512:
+                        batch.append(self.queue.get(timeout=self.flush_interval))
+                except queue.Empty:
+                    pass
+                stop = None in batch
+                out.write(''.join(json.dumps(item) + '\n' for item in batch if item is not None))
+                out.flush()
+                for _ in batch:
+                    self.queue.task_done()
+                if stop:
+                    return
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def summary(self):
+        with self.lock:
+            return {name: {'count': self.counts[name],
+                           'p50_ms': percentile(values, 0.5),
+                           'p95_ms': percentile(values, 0.95)}
+                    for name, values in self.durations.items()}
+
+    def prometheus(self):
+        lines = ['# HELP stockgpt_span_seconds Latency of traced bot operations.',
+                 '# TYPE stockgpt_span_seconds summary']
+        with self.lock:
+            for name in sorted(self.durations):
+                values = self.durations[name]
+                for q in (0.5, 0.95):
+                    lines.append(f'stockgpt_span_seconds{{span="{name}",quantile="{q}"}} {percentile(values, q) / 1000:.6f}')
+                lines.append(f'stockgpt_span_seconds_sum{{span="{name}"}} {self.sums[name] / 1000:.6f}')
+                lines.append(f'stockgpt_span_seconds_count{{span="{name}"}} {self.counts[name]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        with open(path, 'w') as out:
+            out.write(self.prometheus())
+
+
+tracer = Tracer()
@@ -0,0 +1,91 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+import chess
+import chess.polyglot
+
+
+MoveAnnotation = namedtuple('MoveAnnotation', ['move', 'piece_type', 'captured', 'check', 'mate'])
+
+
+def _line_attacks(square, occupied):
+    diag = chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied]
+    straight = (chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied] |
+                chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied])
+    return diag, straight
+
+
+def annotate_moves(board):
+    # Works out capture/check for every legal move from the bitboards, without
+    # pushing anything. Only castling and en passant (which move a second
+    # piece) fall back to gives_check, and only checks are played out for mate.
+    us = board.turn
+    ours = board.occupied_co[us]
+    king = board.king(not us)
+    king_bb = chess.BB_SQUARES[king] if king is not None else 0
+    diag_sliders = (board.bishops | board.queens) & ours
+    straight_sliders = (board.rooks | board.queens) & ours
+
+    annotations = []
+    for move in board.legal_moves:
+        from_bb = chess.BB_SQUARES[move.from_square]
+        to_bb = chess.BB_SQUARES[move.to_square]
+        piece_type = board.piece_type_at(move.from_square)
+        moved_type = move.promotion or piece_type
+
+        if board.is_en_passant(move):
+            captured = chess.PAWN
+            check = board.gives_check(move)
+        elif piece_type == chess.KING and board.is_castling(move):
+            captured = None
+            check = board.gives_check(move)
+        else:
+            captured = board.piece_type_at(move.to_square)
+            if king is None:
+                check = False
+            else:
+                occupied = (board.occupied & ~from_bb) | to_bb
+                diag_after = diag_sliders & ~from_bb
+                straight_after = straight_sliders & ~from_bb
+                if moved_type in (chess.BISHOP, chess.QUEEN):
+                    diag_after |= to_bb
+                if moved_type in (chess.ROOK, chess.QUEEN):
+                    straight_after |= to_bb
+                diag, straight = _line_attacks(king, occupied)
+                check = bool(diag & diag_after or straight & straight_after)
+                if not check and moved_type == chess.KNIGHT:
+                    check = bool(chess.BB_KNIGHT_ATTACKS[move.to_square] & king_bb)
+                elif not check and moved_type == chess.PAWN:
+                    check = bool(chess.BB_PAWN_ATTACKS[us][move.to_square] & king_bb)
+
+        mate = False
+        if check:
+            board.push(move)
+            mate = board.is_checkmate()
+            board.pop()
+        annotations.append(MoveAnnotation(move, piece_type, captured, check, mate))
+    return tuple(annotations)
+
+
+class MoveAnnotator:
+    def __init__(self, max_positions=512):
+        self.max_positions = max_positions
+        self.positions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def annotate(self, board):
+        key = chess.polyglot.zobrist_hash(board)
+        with self.lock:
+            annotations = self.positions.get(key)
+            if annotations is not None:
+                self.positions.move_to_end(key)
+                return annotations
+        annotations = annotate_moves(board)
+        with self.lock:
+            self.positions[key] = annotations
+            while len(self.positions) > self.max_positions:
+                self.positions.popitem(last=False)
+        return annotations
+
+
+annotator = MoveAnnotator()
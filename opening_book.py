@@ -0,0 +1,102 @@
+import argparse
+import random
+import struct
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+
+# Polyglot entry: zobrist key, encoded move, weight, learn
+ENTRY = struct.Struct('>QHHI')
+RESULT_SCORES = {'1-0': (2, 0), '0-1': (0, 2), '1/2-1/2': (1, 1)}
+
+
+class OpeningBook:
+    # Polyglot books are sorted by key, python-chess mmaps the file and bisects it
+    def __init__(self, path, rng=None):
+        self.path = path
+        self.reader = chess.polyglot.open_reader(path)
+        self.rng = rng or random.Random()
+
+    def choose(self, board):
+        try:
+            return self.reader.weighted_choice(board, random=self.rng).move.uci()
+        except IndexError:
+            return None
+
+    def moves(self, board):
+        return [(entry.move.uci(), entry.weight) for entry in self.reader.find_all(board)]
+
+    def close(self):
+        self.reader.close()
+
+
+def encode_move(board, move):
+    to_square = move.to_square
+    if board.is_castling(move):
+        # Polyglot writes castling as the king taking its own rook
+        rook_file = 7 if chess.square_file(move.to_square) > chess.square_file(move.from_square) else 0
+        to_square = chess.square(rook_file, chess.square_rank(move.from_square))
+    promotion = move.promotion - 1 if move.promotion else 0
+    return (chess.square_file(to_square) | chess.square_rank(to_square) << 3 |
+            chess.square_file(move.from_square) << 6 | chess.square_rank(move.from_square) << 9 |
+            promotion << 12)
+
+
+def build_book(pgn_paths, out_path, max_ply=24, min_games=2):
+    # Games are read one at a time, only the per-position move tallies stay in memory
+    stats = {}
+    games = 0
+    for pgn_path in pgn_paths:
+        with open(pgn_path, encoding='utf-8', errors='replace') as handle:
+            while True:
+                game = chess.pgn.read_game(handle)
+                if game is None:
+                    break
+                if 'FEN' in game.headers or game.headers.get('Variant', 'Standard') != 'Standard':
+                    continue
+                scores = RESULT_SCORES.get(game.headers.get('Result'), (1, 1))
+                board = game.board()
+                for ply, move in enumerate(game.mainline_moves()):
+                    if ply >= max_ply:
+                        break
+                    entry_key = (chess.polyglot.zobrist_hash(board), encode_move(board, move))
+                    tally = stats.setdefault(entry_key, [0, 0])
+                    tally[0] += 1
+                    tally[1] += scores[0] if board.turn == chess.WHITE else scores[1]
+                    board.push(move)
+                games += 1
+
+    entries = [(key, raw_move, count, score) for (key, raw_move), (count, score) in stats.items() if count >= min_games]
+    top_score = max([score for _, _, _, score in entries], default=1)
+    scale = max(1.0, top_score / 0xFFFF)
+    entries.sort(key=lambda entry: (entry[0], -entry[3]))
+    with open(out_path, 'wb') as out:
+        for key, raw_move, count, score in entries:
+            # Keep a weight of at least 1 so lost lines stay playable, just rarely
+            out.write(ENTRY.pack(key, raw_move, max(1, int(score / scale)), 0))
+    print(f'Wrote {len(entries)} entries from {games} games to {out_path}')
+    return len(entries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or probe a Polyglot opening book.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='compile a book from PGN files')
+    build.add_argument('pgn', nargs='+')
+    build.add_argument('-o', '--output', default='book.bin')
+    build.add_argument('--max-ply', type=int, default=24)
+    build.add_argument('--min-games', type=int, default=2)
+    probe = sub.add_parser('probe', help='list book moves for a position')
+    probe.add_argument('book')
+    probe.add_argument('fen', nargs='?', default=chess.STARTING_FEN)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_book(args.pgn, args.output, args.max_ply, args.min_games)
+    else:
+        book = OpeningBook(args.book)
+        for uci, weight in book.moves(chess.Board(args.fen)):
+            print(uci, weight)
+        book.close()
@@ -0,0 +1,111 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import chess
+
+from metrics import log
+
+
+PIECE_VALUES = {
+    chess.PAWN: 1,
+    chess.KNIGHT: 3,
+    chess.BISHOP: 3,
+    chess.ROOK: 5,
+    chess.QUEEN: 9,
+    chess.KING: 0
+}
+
+
+def predict_replies(board, limit):
+    # Cheap guess at what the opponent plays: recaptures and other captures by
+    # victim value, then checks and promotions, then everything else.
+    last_square = board.peek().to_square if board.move_stack else None
+    scored = []
+    for move in board.legal_moves:
+        score = 0
+        if board.is_capture(move):
+            victim = board.piece_at(move.to_square)
+            attacker = board.piece_at(move.from_square)
+            score += 10 * (PIECE_VALUES[victim.piece_type] if victim else 1) - PIECE_VALUES[attacker.piece_type]
+            if move.to_square == last_square:
+                score += 20
+        if move.promotion:
+            score += 8 * PIECE_VALUES[move.promotion]
+        if board.gives_check(move):
+            score += 5
+        scored.append((score, move))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return [move for _, move in scored[:limit]]
+
+
+class Ponderer:
+    def __init__(self, client, max_replies=3, workers=3, wait_share=0.25):
+        self.client = client
+        self.max_replies = max_replies
+        # Share of the move budget worth waiting for a job still in flight
+        self.wait_share = wait_share
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        # Called right after our move is on the board, while the opponent thinks
+        self.cancel()
+        board = self.client.board
+        if board.is_game_over():
+            return
+        for move in predict_replies(board, self.max_replies):
+            fork = self.client.fork()
+            captured = fork.move_capture(move)
+            fork.board.push(move)
+            if fork.board.is_game_over():
+                continue
+            cancel = threading.Event()
+            future = self.executor.submit(self.run, fork, move.uci(), captured, cancel)
+            self.jobs[move.uci()] = (future, cancel, fork)
+
+    def run(self, fork, opp_move, captured, cancel):
+        try:
+            return fork.compute_next_move(opp_move, captured, cancel)
+        finally:
+            fork.close_pool()
+
+    def take(self, opp_move, timeout=None):
+        job = self.jobs.pop(opp_move, None)
+        self.cancel()
+        if job is None:
+            self.misses += 1
+            return None
+        future, cancel, fork = job
+        try:
+            # A job still in flight is the right computation, so wait for it rather than start over
+            bot_move = future.result(timeout=timeout)
+        except TimeoutError:
+            cancel.set()
+            fork.close_pool()
+            log.warning('Ponder job for %s did not finish within the move budget', opp_move)
+            self.misses += 1
+            return None
+        except Exception as e:
+            log.warning('Ponder job for %s failed: %r', opp_move, e)
+            self.misses += 1
+            return None
+        if bot_move is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bot_move
+
+    def cancel(self):
+        for future, cancel, fork in self.jobs.values():
+            cancel.set()
+            future.cancel()
+            # Reaches the fork's own proposer and critic queries too
+            fork.close_pool()
+        self.jobs = {}
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+        log.info('Ponder hits: %d, misses: %d', self.hits, self.misses)
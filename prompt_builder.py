@@ -0,0 +1,135 @@
+import threading
+from collections import Counter
+
+import chess
+
+from metrics import log
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+MOVE_LEGEND = ('Moves are grouped by piece as "<piece><from square>: <to squares>", white pieces in capitals. '
+               'A to square is followed by "x" and the captured piece letter for captures, "+" if it gives check '
+               'and "#" if it checkmates. Write a move in UCI as the from square followed by the to square, e.g. b1c3.')
+
+
+def count_tokens(text):
+    if tiktoken is not None:
+        return len(_encoding().encode(text))
+    # Roughly four characters per token for English and board notation
+    return (len(text) + 3) // 4
+
+
+_encoding_cache = []
+
+
+def _encoding():
+    if not _encoding_cache:
+        _encoding_cache.append(tiktoken.encoding_for_model('gpt-4'))
+    return _encoding_cache[0]
+
+
+def squash(text):
+    # The prompt strings are written with backslash continuations, drop the indentation they carry
+    return ' '.join(text.split())
+
+
+def encode_position(board):
+    lines = [f'FEN: {board.fen()}']
+    for color in (chess.WHITE, chess.BLACK):
+        pieces = []
+        for piece_type in (chess.KING, chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT, chess.PAWN):
+            symbol = chess.piece_symbol(piece_type).upper()
+            for square in board.pieces(piece_type, color):
+                pieces.append(f'{symbol}{chess.square_name(square)}')
+        lines.append(f'{chess.COLOR_NAMES[color].capitalize()}: {" ".join(pieces)}')
+    return '\n'.join(lines)
+
+
+def encode_moves(board, annotations):
+    groups = {}
+    for annotation in annotations:
+        move = annotation.move
+        target = chess.square_name(move.to_square)
+        if move.promotion:
+            target += chess.piece_symbol(move.promotion)
+        if annotation.captured:
+            target += 'x' + chess.piece_symbol(annotation.captured)
+        if annotation.mate:
+            target += '#'
+        elif annotation.check:
+            target += '+'
+        groups.setdefault(move.from_square, []).append(target)
+    lines = []
+    for from_square, targets in groups.items():
+        piece = board.piece_at(from_square)
+        lines.append(f'{piece.symbol()}{chess.square_name(from_square)}: {" ".join(targets)}')
+    return '\n'.join(lines)
+
+
+class PromptBuilder:
+    def __init__(self):
+        self.prefixes = {}
+        self.prefix_tokens = {}
+        self.lock = threading.Lock()
+        self.tokens = Counter()
+        self.prompts = Counter()
+
+    def static_prefix(self, *parts):
+        # Instruction text comes first and is byte-identical for every move
+        # of a stage, so provider-side prefix caching can reuse it.
+        prefix = self.prefixes.get(parts)
+        if prefix is None:
+            prefix = '\n'.join(squash(part) for part in parts if part) + '\n'
+            self.prefixes[parts] = prefix
+        return prefix
+
+    def proposer(self, static_parts, color, board, annotations, opp_move, captured_by_opp=None, proposed_move='', critique='', span=None):
+        prompt = [
+            self.static_prefix(*static_parts, MOVE_LEGEND),
+            f'You are playing {color}. You may be starting in the middle of a game.\n',
+            f'POSITION:\n{encode_position(board)}\n',
+            f'LEGAL MOVES:\n{encode_moves(board, annotations)}\n',
+            f'OPPONENT MOVE: {opp_move or "none"}\n',
+        ]
+        if captured_by_opp:
+            prompt.append(f'OPPONENT CAPTURED: {captured_by_opp}\n')
+        if critique != '' and proposed_move != '':
+            prompt.append(f'PREVIOUS PROPOSED MOVE: {proposed_move}\nCRITIQUE OF PREVIOUS PROPOSED MOVE:\n{critique}\n')
+        return self.account('proposer', ''.join(prompt), prompt[0], span)
+
+    def critic(self, static_parts, color, board, opp_move, proposed_move, opp_annotations, board_after, captured_by_us=None, captured_by_opp=None, span=None):
+        prompt = [
+            self.static_prefix(*static_parts, MOVE_LEGEND),
+            f'We are playing {color}.\n',
+            f'POSITION:\n{encode_position(board)}\n',
+            f'OPPONENT MOVE: {opp_move or "none"}\n',
+        ]
+        if captured_by_opp:
+            prompt.append(f'OPPONENT CAPTURED: {captured_by_opp}\n')
+        prompt.append(f'OUR PROPOSED MOVE: {proposed_move}\n')
+        if captured_by_us:
+            prompt.append(f'OUR PROPOSED MOVE CAPTURES: {captured_by_us}\n')
+        prompt.append(f'OPPONENT LEGAL MOVES AFTER OUR PROPOSED MOVE:\n{encode_moves(board_after, opp_annotations)}\n')
+        return self.account('critic', ''.join(prompt), prompt[0], span)
+
+    def account(self, role, prompt, static, span=None):
+        tokens = count_tokens(prompt)
+        static_tokens = self.prefix_tokens.get(static)
+        if static_tokens is None:
+            static_tokens = self.prefix_tokens[static] = count_tokens(static)
+        with self.lock:
+            self.tokens[role] += tokens
+            self.prompts[role] += 1
+        if span is not None:
+            span['tokens'] = tokens
+            span['static_tokens'] = static_tokens
+        log.debug('%s prompt: %d tokens, %d in static prefix', role, tokens, static_tokens)
+        return prompt
+
+    def stats(self):
+        with self.lock:
+            return {role: {'prompts': self.prompts[role], 'tokens': self.tokens[role]} for role in self.prompts}
@@ -0,0 +1,163 @@
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import chess.polyglot
+
+
+class ResponseCache:
+    # Memory in front of SQLite. Lookups read the database directly, but
+    # writes, access times and expiry deletes go through a queue to a
+    # background thread that commits them in batches, so the query path never
+    # waits on a commit.
+    def __init__(self, path='gpt_cache.sqlite', max_memory_entries=1024, max_disk_entries=50000, ttl=7 * 24 * 3600,
+                 batch_size=256, flush_interval=1.0, clock=time.time):
+        self.path = path
+        # Wall clock, entries outlive the process
+        self.clock = clock
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes_since_evict = 0
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = None
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                            'key TEXT PRIMARY KEY, zobrist TEXT, phase TEXT, role TEXT, '
+                            'response TEXT, created REAL, accessed REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self.db.commit()
+
+    def make_key(self, board, phase, role, prompt, sample=0):
+        # The prompt digest keeps later rounds (which carry a critique) from
+        # being answered with the first round's response for the same position.
+        # Parallel samples of one prompt each get their own entry.
+        zobrist = f'{chess.polyglot.zobrist_hash(board):016x}'
+        digest = hashlib.sha1(prompt.encode('utf-8'))
+        if sample:
+            digest.update(f'#{sample}'.encode('utf-8'))
+        digest = digest.hexdigest()
+        return f'{zobrist}:{phase}:{role}:{digest}'
+
+    def get(self, key):
+        now = self.clock()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                response, created = entry
+                if now - created <= self.ttl:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self.memory[key]
+
+            if self.db is not None:
+                row = self.db.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    response, created = row
+                    if now - created <= self.ttl:
+                        self._write('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+                        self._remember(key, response, created)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return response
+                    self._write('DELETE FROM responses WHERE key = ?', (key,))
+
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        now = self.clock()
+        with self.lock:
+            self._remember(key, response, now)
+            if self.db is None:
+                return
+            zobrist, phase, role, _ = key.split(':', 3)
+            self._write('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (key, zobrist, phase, role, response, now, now))
+
+    def _write(self, sql, params):
+        self.queue.put((sql, params))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='cache-writer', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        db = sqlite3.connect(self.path)
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+            stop = None in batch
+            with db:
+                for item in batch:
+                    if item is None:
+                        continue
+                    sql, params = item
+                    db.execute(sql, params)
+                    if sql.startswith('INSERT'):
+                        self.writes_since_evict += 1
+                if self.writes_since_evict >= 100 or stop:
+                    self._evict(db, self.clock())
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                db.close()
+                return
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+    def _remember(self, key, response, created):
+        self.memory[key] = (response, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict(self, db, now):
+        self.writes_since_evict = 0
+        db.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+        count = db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if count > self.max_disk_entries:
+            db.execute('DELETE FROM responses WHERE key IN '
+                       '(SELECT key FROM responses ORDER BY accessed LIMIT ?)',
+                       (count - self.max_disk_entries,))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'memory_entries': len(self.memory),
+            }
+
+    def close(self):
+        # The writer evicts once more on its way out
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
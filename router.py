@@ -0,0 +1,89 @@
+import threading
+from collections import Counter, namedtuple
+
+import chess
+
+from tactics import PIECE_VALUES, evaluate
+
+
+TIERS = ('instant', 'light', 'full')
+PHASE_WEIGHTS = {'OPENING': 5, 'MID': 15, 'END': 0}
+
+Route = namedtuple('Route', ['tier', 'score', 'features', 'move', 'reason'])
+
+
+def position_features(board, annotations, phase):
+    return {
+        'legal_moves': len(annotations),
+        'captures': sum(1 for annotation in annotations if annotation.captured),
+        'checks': sum(1 for annotation in annotations if annotation.check),
+        'mates': sum(1 for annotation in annotations if annotation.mate),
+        'in_check': board.is_check(),
+        'material': evaluate(board),
+        'pieces': chess.popcount(board.occupied),
+        'phase': phase,
+    }
+
+
+class Router:
+    # Decides how much thinking a position deserves from features that cost
+    # next to nothing: play it on the spot, ask the light model once, or run
+    # the full proposer/critic loop. Thresholds are meant to be tuned from the
+    # tier/score/features fields on the compute_next_move traces.
+    def __init__(self, light_model='gpt-3.5-turbo', light_threshold=30, simple_endgame_pieces=8, winning_material=500):
+        self.light_model = light_model
+        self.light_threshold = light_threshold
+        self.simple_endgame_pieces = simple_endgame_pieces
+        self.winning_material = winning_material
+        self.outcomes = Counter()
+        self.lock = threading.Lock()
+
+    def score(self, features):
+        score = (features['legal_moves'] + 4 * features['captures'] + 3 * features['checks'] +
+                 PHASE_WEIGHTS[features['phase']])
+        if features['in_check']:
+            score += 10
+        return score
+
+    def route(self, board, annotations, phase, captured_by_opp=None):
+        features = position_features(board, annotations, phase)
+        move, reason = self.instant_move(board, annotations, features, captured_by_opp)
+        if move is not None:
+            return Route('instant', 0, features, move, reason)
+        score = self.score(features)
+        simple_endgame = (features['phase'] == 'END' and features['pieces'] <= self.simple_endgame_pieces and
+                          abs(features['material']) >= self.winning_material)
+        tier = 'light' if score < self.light_threshold or simple_endgame else 'full'
+        return Route(tier, score, features, None, None)
+
+    def instant_move(self, board, annotations, features, captured_by_opp=None):
+        if features['legal_moves'] == 1:
+            return annotations[0].move.uci(), 'only legal move'
+        for annotation in annotations:
+            if annotation.mate:
+                return annotation.move.uci(), 'mate in one'
+        if captured_by_opp and board.move_stack and not features['checks']:
+            # Take back with the cheapest piece when even losing it afterwards is a fair trade,
+            # unless something bigger than the recaptured piece is hanging elsewhere
+            square = board.peek().to_square
+            recaptures = [annotation for annotation in annotations if annotation.move.to_square == square and annotation.captured]
+            if recaptures:
+                best = min(recaptures, key=lambda annotation: PIECE_VALUES[annotation.piece_type])
+                victim = PIECE_VALUES[best.captured]
+                other = max((PIECE_VALUES[annotation.captured] for annotation in annotations
+                             if annotation.captured and annotation.move.to_square != square), default=0)
+                if victim >= PIECE_VALUES[best.piece_type] and victim >= other:
+                    return best.move.uci(), f'recapture with the {chess.piece_name(best.piece_type)}'
+        return None, None
+
+    def record(self, tier, outcome):
+        # outcome is where the move finally came from, 'rounds' after a light tier means it escalated
+        with self.lock:
+            self.outcomes[(tier, outcome)] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for (tier, outcome), count in sorted(self.outcomes.items()):
+                stats.setdefault(tier, {})[outcome] = count
+            return stats
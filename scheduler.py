@@ -0,0 +1,101 @@
+import threading
+import time
+
+
+# Lichess reports games without a clock with a huge remaining time
+UNLIMITED_MS = 24 * 3600 * 1000
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, budget, clock=time.monotonic):
+        self.clock = clock
+        self.budget = budget
+        self.end = clock() + budget
+
+    def remaining(self):
+        return max(self.end - self.clock(), 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded(f'move budget of {self.budget:.1f}s used up')
+
+
+class MoveScheduler:
+    # Turns the clock fields of a gameState event into a time budget for the
+    # move and decides how many proposer/critic rounds still fit in it. The
+    # round estimate is learnt from how long completions actually take.
+    def __init__(self, clock=time.monotonic, moves_to_go=30, increment_share=0.8, max_share=0.2,
+                 overhead=1.0, min_budget=0.5, query_estimate=None, queries_per_round=2, max_rounds=3):
+        self.clock = clock
+        self.moves_to_go = moves_to_go
+        self.increment_share = increment_share
+        self.max_share = max_share
+        self.overhead = overhead
+        self.min_budget = min_budget
+        # Seconds per completion, None until the first one has been timed
+        self.query_estimate = query_estimate
+        self.queries_per_round = queries_per_round
+        self.max_rounds = max_rounds
+        self.lock = threading.Lock()
+
+    def budget(self, state, color):
+        prefix = 'w' if color == 'white' else 'b'
+        remaining_ms = state.get(f'{prefix}time')
+        if remaining_ms is None or remaining_ms >= UNLIMITED_MS:
+            return None
+        remaining = remaining_ms / 1000
+        increment = state.get(f'{prefix}inc', 0) / 1000
+        budget = remaining / self.moves_to_go + self.increment_share * increment
+        # Never bet more than a share of the clock, and leave room for network lag
+        budget = min(budget, remaining * self.max_share + increment) - self.overhead
+        return max(budget, min(self.min_budget, remaining / 2))
+
+    def deadline(self, state, color):
+        budget = self.budget(state, color)
+        if budget is None:
+            return None
+        return Deadline(budget, self.clock)
+
+    def flag_deadline(self, state, color):
+        # What is left on our clock, a move post still retrying past it loses on time
+        remaining_ms = state.get(('w' if color == 'white' else 'b') + 'time')
+        if remaining_ms is None or remaining_ms >= UNLIMITED_MS:
+            return None
+        return Deadline(remaining_ms / 1000, self.clock)
+
+    def round_estimate(self):
+        with self.lock:
+            if self.query_estimate is None:
+                return None
+            return self.queries_per_round * self.query_estimate
+
+    def rounds_left(self, deadline, rounds_done):
+        if deadline is None:
+            return self.max_rounds - rounds_done
+        estimate = self.round_estimate()
+        if not estimate:
+            # Nothing measured yet, try a round and let the deadline cut it short if need be
+            return self.max_rounds - rounds_done
+        # Start a round that only half fits, the proposal is worth having even if the critic gets cut off
+        fit = int(deadline.remaining() / estimate + 0.5)
+        return max(min(self.max_rounds - rounds_done, fit), 0)
+
+    def critical(self, deadline):
+        # Not even a proposal fits, answer locally
+        return deadline is not None and self.rounds_left(deadline, 0) == 0
+
+    def record_query(self, seconds):
+        # Every completion on every path, including ones the deadline cut off,
+        # which took at least this long
+        with self.lock:
+            if self.query_estimate is None:
+                self.query_estimate = seconds
+            else:
+                self.query_estimate = 0.7 * self.query_estimate + 0.3 * seconds
@@ -0,0 +1,219 @@
+import time
+from collections import namedtuple
+
+import chess
+import chess.polyglot
+
+
+PIECE_VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 320,
+    chess.BISHOP: 330,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0
+}
+MATE = 100000
+MATE_BOUND = MATE - 1000
+EXACT, LOWER, UPPER = 0, 1, 2
+
+SearchResult = namedtuple('SearchResult', ['move', 'score', 'depth', 'nodes'])
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def evaluate(board):
+    # Material from the side to move's point of view
+    score = 0
+    for piece_type, value in PIECE_VALUES.items():
+        score += value * (chess.popcount(board.pieces_mask(piece_type, chess.WHITE)) -
+                          chess.popcount(board.pieces_mask(piece_type, chess.BLACK)))
+    return score if board.turn == chess.WHITE else -score
+
+
+def capture_order(board, move):
+    # MVV-LVA: most valuable victim first, cheapest attacker breaks ties
+    victim = chess.PAWN if board.is_en_passant(move) else board.piece_type_at(move.to_square)
+    return 10 * PIECE_VALUES[victim] - PIECE_VALUES[board.piece_type_at(move.from_square)]
+
+
+def is_mate_score(score):
+    return abs(score) >= MATE_BOUND
+
+
+class Search:
+    # State of one search call, several can share a transposition table
+    def __init__(self, board, table, deadline):
+        self.board = board.copy()
+        self.table = table
+        self.deadline = deadline
+        self.nodes = 0
+        self.killers = {}
+
+    def tick(self):
+        self.nodes += 1
+        if self.nodes & 1023 == 0 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def ordered(self, moves, tt_move, ply):
+        killers = self.killers.get(ply, ())
+
+        def key(move):
+            if move == tt_move:
+                return 100000
+            if self.board.is_capture(move):
+                return 10000 + capture_order(self.board, move)
+            if move.promotion:
+                return 9000 + PIECE_VALUES[move.promotion]
+            if move in killers:
+                return 8000
+            return 0
+        return sorted(moves, key=key, reverse=True)
+
+    def negamax(self, depth, alpha, beta, ply):
+        self.tick()
+        board = self.board
+        if ply > 0 and (board.is_repetition(2) or board.halfmove_clock >= 100):
+            return 0, None
+
+        key = chess.polyglot.zobrist_hash(board)
+        entry = self.table.get(key)
+        tt_move = None
+        if entry is not None:
+            entry_depth, entry_score, flag, tt_move = entry
+            if entry_depth >= depth and ply > 0:
+                if flag == EXACT:
+                    return entry_score, tt_move
+                if flag == LOWER and entry_score >= beta:
+                    return entry_score, tt_move
+                if flag == UPPER and entry_score <= alpha:
+                    return entry_score, tt_move
+
+        moves = list(board.legal_moves)
+        if not moves:
+            return (-MATE + ply if board.is_check() else 0), None
+        if depth <= 0:
+            return self.quiesce(alpha, beta, ply), None
+
+        original_alpha = alpha
+        best_score = -MATE - 1
+        best_move = None
+        for move in self.ordered(moves, tt_move, ply):
+            board.push(move)
+            score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)[0]
+            board.pop()
+            if score > best_score:
+                best_score = score
+                best_move = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not board.is_capture(move):
+                    self.killers[ply] = (move,) + self.killers.get(ply, ())[:1]
+                break
+
+        flag = EXACT
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        # Mate scores depend on the ply they were found at, only keep exact distances at the root
+        if not is_mate_score(best_score) or ply == 0:
+            self.table[key] = (depth, best_score, flag, best_move)
+        return best_score, best_move
+
+    def quiesce(self, alpha, beta, ply):
+        self.tick()
+        board = self.board
+        stand_pat = evaluate(board)
+        if ply > 32:
+            return stand_pat
+        if board.is_check():
+            # Not safe to stand pat in check, look at every evasion
+            moves = list(board.legal_moves)
+            if not moves:
+                return -MATE + ply
+            stand_pat = -MATE + ply
+        else:
+            if stand_pat >= beta:
+                return stand_pat
+            moves = list(board.generate_legal_captures())
+        alpha = max(alpha, stand_pat)
+        best = stand_pat
+        for move in sorted(moves, key=lambda move: capture_order(board, move) if board.is_capture(move) else -10000, reverse=True):
+            board.push(move)
+            score = -self.quiesce(-beta, -alpha, ply + 1)
+            board.pop()
+            if score > best:
+                best = score
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+        return best
+
+
+class TacticalSearcher:
+    def __init__(self, max_depth=4, budget=0.5, win_margin=250, blunder_margin=200, max_entries=500000):
+        self.max_depth = max_depth
+        self.budget = budget
+        self.win_margin = win_margin
+        self.blunder_margin = blunder_margin
+        self.max_entries = max_entries
+        self.table = {}
+
+    def search(self, board, budget=None, max_depth=None):
+        # Iterative deepening, returns the deepest fully searched result
+        if len(self.table) > self.max_entries:
+            self.table = {}
+        deadline = time.monotonic() + (self.budget if budget is None else budget)
+        search = Search(board, self.table, deadline)
+        result = None
+        for depth in range(1, (max_depth or self.max_depth) + 1):
+            try:
+                score, move = search.negamax(depth, -MATE - 1, MATE + 1, 0)
+            except SearchTimeout:
+                break
+            result = SearchResult(move, score, depth, search.nodes)
+            if is_mate_score(score):
+                break
+        return result
+
+    def find_forced(self, board, budget=None):
+        # A mate for us, or a capture that wins clear material, needs no discussion
+        moves = list(board.legal_moves)
+        if len(moves) == 1:
+            return SearchResult(moves[0], None, 0, 0), 'only legal move'
+        result = self.search(board, budget)
+        if result is None or result.move is None:
+            return None, None
+        if result.score >= MATE_BOUND:
+            return result, f'mate in {(MATE - result.score + 1) // 2}'
+        gain = result.score - evaluate(board)
+        if result.depth >= 2 and board.is_capture(result.move) and gain >= self.win_margin:
+            return result, f'wins {gain} centipawns of material'
+        return None, None
+
+    def veto(self, board, move, budget=None):
+        # Returns a critique when the move drops material against the best line found
+        best = self.search(board, budget)
+        if best is None or best.move is None or move == best.move:
+            return None
+        after = board.copy()
+        after.push(move)
+        reply = self.search(after, budget, max(best.depth - 1, 1))
+        if reply is None:
+            return None
+        score = -reply.score
+        loss = best.score - score
+        if loss < self.blunder_margin:
+            return None
+        if reply.move is None:
+            return f'The proposed move {move.uci()} ends the game in a draw while we are ahead.'
+        if reply.score >= MATE_BOUND:
+            return (f'The proposed move {move.uci()} allows the opponent to force checkmate '
+                    f'starting with {reply.move.uci()}.')
+        return (f'The proposed move {move.uci()} loses about {loss // 100} pawns of material, '
+                f'the opponent answers {reply.move.uci()}. {best.move.uci()} keeps the material.')
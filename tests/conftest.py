@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from chess_client import ChessClient
+from game_sessions import GameSessions
+from game_store import GameStore
+from metrics import tracer
+from response_cache import ResponseCache
+from scheduler import MoveScheduler
+
+
+class FakeClock:
+    # Stands in for time.monotonic, time only moves when a test says so
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture(autouse=True)
+def no_trace_file(monkeypatch):
+    # Spans still count, they just don't go to traces.jsonl in the working directory
+    monkeypatch.setattr(tracer, 'path', None)
+
+
+@pytest.fixture
+def make_client(tmp_path, clock):
+    # White to move in game 'test', with everything it writes kept in tmp_path
+    clients = []
+
+    def make(scheduler=None, **kwargs):
+        client = ChessClient(cache=ResponseCache(path=None), scheduler=scheduler or MoveScheduler(clock),
+                             sessions=GameSessions(str(tmp_path / 'games.json')),
+                             store=GameStore(str(tmp_path / 'games.sqlite'), flush_interval=0.01), **kwargs)
+        client.resume('test', 'white')
+        clients.append(client)
+        return client
+    yield make
+    for client in clients:
+        client.store.close()
+
+
+@pytest.fixture
+def client(make_client):
+    return make_client()
@@ -0,0 +1,73 @@
+import json
+from contextlib import contextmanager
+
+import pytest
+
+from gpt_client import GPTAgent, find_answer, sse_deltas
+
+ABANDONED_STATUS = 'If it were safe I would write STATUS: SUCCESS.\nHowever the queen hangs.\nSTATUS: FAIL'
+ABANDONED_UCI = 'First idea, UCI: e2e4.\nBut that loses a pawn, so instead\nUCI: d2d4'
+
+
+def sse(text, pieces=5, trailer=True):
+    # text cut into pieces as a streamed completion, ending the way the API does
+    size = max(len(text) // pieces, 1)
+    lines = []
+    for start in range(0, len(text), size):
+        chunk = {'choices': [{'index': 0, 'delta': {'content': text[start:start + size]}, 'finish_reason': None}]}
+        lines.append(f'data: {json.dumps(chunk)}'.encode())
+        lines.append(b'')
+    lines.append(f'data: {json.dumps({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})}'.encode())
+    if trailer:
+        lines.append(b'data: [DONE]')
+    return lines
+
+
+class FakeTransport:
+    def __init__(self, lines):
+        self.lines = lines
+        self.read = 0
+
+    @contextmanager
+    def post(self, url, **kwargs):
+        yield self
+
+    def iter_lines(self):
+        for line in self.lines:
+            self.read += 1
+            yield line
+
+
+def streamed(text, marker, lines=None):
+    agent = GPTAgent(stream=True)
+    agent.transport = FakeTransport(lines if lines is not None else sse(text))
+    return agent.stream_completion({}, marker)
+
+
+@pytest.mark.parametrize('text, marker, answer', [
+    (ABANDONED_STATUS, 'STATUS', 'FAIL'),
+    (ABANDONED_UCI, 'UCI', 'd2d4'),
+    ('Nothing to add.\nSTATUS: SUCCESS', 'STATUS', 'SUCCESS'),
+    ('The pawn promotes.\nUCI: e7e8q', 'UCI', 'e7e8q'),
+    ('Play it.\n**UCI: "g1f3"**.', 'UCI', 'g1f3'),
+    ('UCI: e2e4 was my first thought, then UCI: e2e4e5', 'UCI', 'e2e4'),
+    ('No answer here', 'UCI', None),
+])
+def test_streamed_and_complete_text_agree_on_the_last_marker(text, marker, answer):
+    assert find_answer(text, marker) == answer
+    assert streamed(text, marker) == (text, answer)
+
+
+def test_stream_is_read_to_the_finish_only():
+    text = 'Thinking.\nUCI: d2d4'
+    lines = sse(text) + [b'data: {"choices": [], "usage": {"completion_tokens": 5}}', b'data: not json']
+    agent = GPTAgent(stream=True)
+    agent.transport = FakeTransport(lines)
+    assert agent.stream_completion({}, 'UCI') == (text, 'd2d4')
+    # Nothing after the finish_reason chunk is read
+    assert agent.transport.read == len(sse(text, trailer=False))
+
+
+def test_stream_without_finish_reason_ends_at_done():
+    lines = [b'data: {"choices": [{"delta": {"content": "UCI: a2a3"}}]}', b'data: [DONE]', b'data: not json']
+    assert list(sse_deltas(lines)) == ['UCI: a2a3']
@@ -0,0 +1,97 @@
+import threading
+
+import pytest
+
+from gpt_client import find_answer
+
+
+def answer(text):
+    return lambda prompt, board=None, phase=None, sample=0, marker=None, deadline=None: text
+
+
+def test_straggler_lands_in_its_own_move_transcript(make_client):
+    client = make_client(fan_out=2, deadline=0.2)
+    release = threading.Event()
+
+    def propose(prompt, board=None, phase=None, sample=0, marker=None, deadline=None):
+        if sample == 1:
+            release.wait(5)
+            return 'Late. UCI: d2d4'
+        return 'UCI: e2e4'
+    client.agent.query = propose
+    client.critic_agent.query = answer('STATUS: SUCCESS')
+    assert client.compute_next_move('') == 'e2e4'
+    transcript = client.last_decision['transcript']
+    # The next move starts before the straggler comes back
+    client.transcript = []
+    release.set()
+    client.pool.shutdown(wait=True)
+    assert [find_answer(entry['response'], 'UCI') for entry in transcript if entry['role'] == 'proposer'] == ['e2e4', 'd2d4']
+    assert client.transcript == []
+
+
+def test_ponder_forks_use_their_own_workers_and_stop_on_cancel(make_client):
+    client = make_client(fan_out=2, deadline=10, ponder=True)
+    started = threading.Semaphore(0)
+    release = threading.Event()
+    critiques = []
+
+    def propose(prompt, board=None, phase=None, sample=0, marker=None, deadline=None):
+        started.release()
+        release.wait(5)
+        return 'UCI: e7e5'
+    client.agent.query = propose
+    client.critic_agent.query = lambda *args, **kwargs: critiques.append(args) or 'STATUS: SUCCESS'
+    client.board.push_uci('e2e4')
+    client.ponderer.start()
+    forks = [fork for _, _, fork in client.ponderer.jobs.values()]
+    assert len(forks) == client.ponderer.max_replies
+    for _ in range(len(forks) * client.fan_out):
+        assert started.acquire(timeout=5)
+    # None of the forks' queries took a worker from the real move's pool
+    assert client.pool is None
+
+    client.ponderer.cancel()
+    release.set()
+    client.ponderer.executor.shutdown(wait=True)
+    assert critiques == []
+    for fork in forks:
+        with pytest.raises(RuntimeError):
+            fork.pool.submit(print)
+
+
+def test_ponder_forks_leave_the_routing_stats_alone(make_client):
+    client = make_client(route=True)
+    for agent in (client.agent, client.critic_agent, client.light_agent):
+        agent.query = answer('UCI: e2e4\nSTATUS: SUCCESS')
+    client.fork().compute_next_move('')
+    assert client.router.stats() == {}
+    client.compute_next_move('')
+    assert sum(sum(outcomes.values()) for outcomes in client.router.stats().values()) == 1
+
+
+def test_lone_candidate_rejected_by_the_critic_is_not_played(make_client):
+    client = make_client(fan_out=2, deadline=5)
+    client.agent.query = answer('UCI: e2e4')
+    client.critic_agent.query = answer('STATUS: FAIL')
+    client.fallback_move = lambda deadline=None: 'd2d4'
+    assert client.compute_next_move('') == 'd2d4'
+
+
+def test_critic_verdict_outranks_votes(make_client):
+    client = make_client(fan_out=3, deadline=5)
+    client.agent.query = lambda prompt, board=None, phase=None, sample=0, **kwargs: 'UCI: d2d4' if sample == 0 else 'UCI: e2e4'
+    client.fallback_move = lambda deadline=None: 'a2a3'
+
+    def critic(verdict_for):
+        return lambda prompt, *args, **kwargs: f'STATUS: {verdict_for(prompt)}'
+    client.critic_agent.query = critic(lambda prompt: 'FAIL' if 'e2e4' in prompt else 'SUCCESS')
+    assert client.compute_next_move('') == 'd2d4'
+
+    # No verdict (a failed critic) still beats a rejection
+    def flaky(prompt, *args, **kwargs):
+        if 'd2d4' in prompt:
+            raise Exception('Error in game creation')
+        return 'STATUS: FAIL'
+    client.critic_agent.query = flaky
+    assert client.compute_next_move('') == 'd2d4'
@@ -0,0 +1,105 @@
+import sqlite3
+
+import pytest
+
+from response_cache import ResponseCache
+
+DAY = 24 * 3600
+
+
+def key(n):
+    return f'{n:016x}:OPENING:proposer:{n}'
+
+
+@pytest.fixture
+def open_cache(tmp_path, clock):
+    # Caches on one database file, closed at the end of the test
+    caches = []
+
+    def make(**kwargs):
+        cache = ResponseCache(path=str(tmp_path / 'cache.sqlite'), clock=clock, flush_interval=0.01, **kwargs)
+        caches.append(cache)
+        return cache
+    yield make
+    for cache in caches:
+        cache.close()
+
+
+def stored(cache):
+    db = sqlite3.connect(cache.path)
+    try:
+        return {row[0]: row[1:] for row in db.execute('SELECT key, created, accessed FROM responses')}
+    finally:
+        db.close()
+
+
+def test_memory_keeps_the_most_recently_used(clock):
+    cache = ResponseCache(path=None, max_memory_entries=2, clock=clock)
+    cache.put(key(1), 'one')
+    cache.put(key(2), 'two')
+    assert cache.get(key(1)) == 'one'
+    cache.put(key(3), 'three')
+    assert cache.get(key(2)) is None
+    assert (cache.get(key(1)), cache.get(key(3))) == ('one', 'three')
+    assert cache.stats()['memory_entries'] == 2
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ResponseCache(path=None, ttl=DAY, clock=clock)
+    cache.put(key(1), 'one')
+    clock.advance(DAY)
+    assert cache.get(key(1)) == 'one'
+    clock.advance(1)
+    assert cache.get(key(1)) is None
+    assert cache.stats()['misses'] == 1
+
+
+def test_writes_reach_the_database_on_flush(open_cache, clock):
+    cache = open_cache()
+    cache.put(key(1), 'one')
+    cache.flush()
+    assert stored(cache) == {key(1): (clock.now, clock.now)}
+
+    # A new process starts from disk, and its hit refreshes the access time
+    clock.advance(60)
+    fresh = open_cache()
+    assert fresh.get(key(1)) == 'one'
+    fresh.flush()
+    assert stored(fresh)[key(1)] == (clock.now - 60, clock.now)
+    assert fresh.stats()['disk_hits'] == 1
+
+
+def test_expired_disk_entries_are_deleted(open_cache, clock):
+    cache = open_cache(ttl=DAY)
+    cache.put(key(1), 'one')
+    cache.flush()
+    clock.advance(DAY + 1)
+    fresh = open_cache(ttl=DAY)
+    assert fresh.get(key(1)) is None
+    fresh.flush()
+    assert stored(fresh) == {}
+
+
+def test_eviction_drops_the_least_recently_accessed(open_cache, clock):
+    cache = open_cache(max_disk_entries=2)
+    for n in (1, 2, 3):
+        cache.put(key(n), str(n))
+        clock.advance(1)
+    cache.flush()
+    fresh = open_cache(max_disk_entries=2)
+    assert fresh.get(key(1)) == '1'
+    fresh.flush()
+    assert len(stored(cache)) == 3
+    # The writer evicts on its way out, 2 is the entry accessed least recently
+    cache.close()
+    assert set(stored(cache)) == {key(1), key(3)}
+
+
+def test_eviction_runs_during_writes(open_cache, clock):
+    cache = open_cache(max_disk_entries=50, batch_size=10)
+    for n in range(120):
+        cache.put(key(n), str(n))
+        clock.advance(1)
+    cache.flush()
+    # Every 100 inserts, not only at close
+    assert len(stored(cache)) <= 70
@@ -0,0 +1,101 @@
+import chess
+import pytest
+
+from gpt_client import GPTAgent
+from scheduler import UNLIMITED_MS, Deadline, DeadlineExceeded, MoveScheduler
+from transport import Transport
+
+
+def test_deadline_follows_the_injected_clock(clock):
+    deadline = Deadline(2.0, clock)
+    assert deadline.remaining() == 2.0
+    clock.advance(1.5)
+    assert deadline.remaining() == pytest.approx(0.5)
+    assert not deadline.expired()
+    clock.advance(1.0)
+    assert deadline.remaining() == 0.0
+    assert deadline.expired()
+    with pytest.raises(DeadlineExceeded):
+        deadline.check()
+
+
+def test_unlimited_games_have_no_budget(clock):
+    scheduler = MoveScheduler(clock)
+    assert scheduler.budget({'wtime': UNLIMITED_MS, 'btime': UNLIMITED_MS}, 'white') is None
+    assert scheduler.budget({}, 'black') is None
+    assert scheduler.deadline({}, 'black') is None
+
+
+def test_budget_from_clock_fields(clock):
+    scheduler = MoveScheduler(clock)
+    # 60s / 30 moves + 0.8 * 1s increment, less 1s overhead
+    assert scheduler.budget({'btime': 60000, 'binc': 1000}, 'black') == pytest.approx(1.8)
+    # Never below min_budget while there is time on the clock
+    assert scheduler.budget({'wtime': 2000, 'winc': 0}, 'white') == pytest.approx(0.5)
+    deadline = scheduler.deadline({'wtime': 300000, 'winc': 0}, 'white')
+    clock.advance(9.0)
+    assert deadline.remaining() == pytest.approx(0.0)
+
+
+def test_first_round_is_tried_before_anything_is_measured(clock):
+    scheduler = MoveScheduler(clock)
+    deadline = Deadline(0.3, clock)
+    assert scheduler.rounds_left(deadline, 0) == scheduler.max_rounds
+    assert not scheduler.critical(deadline)
+
+
+def test_round_estimate_learns_from_queries(clock):
+    scheduler = MoveScheduler(clock, queries_per_round=2)
+    scheduler.record_query(1.0)
+    assert scheduler.round_estimate() == pytest.approx(2.0)
+    scheduler.record_query(2.0)
+    assert scheduler.round_estimate() == pytest.approx(2 * (0.7 * 1.0 + 0.3 * 2.0))
+
+    scheduler = MoveScheduler(clock, query_estimate=1.0)
+    deadline = Deadline(4.0, clock)
+    assert scheduler.rounds_left(deadline, 0) == 2
+    assert scheduler.rounds_left(deadline, 2) == 1
+    clock.advance(3.5)
+    # Half a round still fits, a proposal is worth having
+    assert scheduler.rounds_left(deadline, 0) == 0
+    assert scheduler.critical(deadline)
+
+
+def test_transport_refuses_requests_past_the_deadline(clock):
+    deadline = Deadline(1.0, clock)
+    transport = Transport(timeout=(5, 120))
+    assert transport.clamp(transport.timeout, deadline) == (1.0, 1.0)
+    clock.advance(1.0)
+    with pytest.raises(DeadlineExceeded):
+        transport.request('GET', 'http://127.0.0.1:9/never', deadline=deadline)
+
+
+def test_query_checks_the_deadline_before_sending(clock):
+    agent = GPTAgent(base_url='http://127.0.0.1:9')
+    deadline = Deadline(0.0, clock)
+    with pytest.raises(DeadlineExceeded):
+        agent.query('prompt', chess.Board(), 'OPENING', deadline=deadline)
+
+
+def test_critical_clock_skips_gpt(make_client, clock):
+    client = make_client(MoveScheduler(clock, query_estimate=5.0))
+    def fail(*args, **kwargs):
+        raise AssertionError('GPT must not be asked')
+    client.agent.query = fail
+    client.critic_agent.query = fail
+    move = client.compute_next_move('', deadline=Deadline(2.0, clock))
+    assert chess.Move.from_uci(move) in client.board.legal_moves
+    assert client.last_decision['source'] == 'clock'
+
+
+def test_failed_queries_fall_back_to_a_legal_move(make_client, clock):
+    client = make_client(MoveScheduler(clock, query_estimate=5.0))
+    calls = []
+
+    def fail(*args, **kwargs):
+        calls.append(kwargs.get('deadline'))
+        raise Exception('Error in game creation')
+    client.agent.query = fail
+    move = client.compute_next_move('', deadline=Deadline(60.0, clock))
+    assert len(calls) == client.scheduler.max_rounds
+    assert chess.Move.from_uci(move) in client.board.legal_moves
@@ -0,0 +1,143 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+
+def posted(status_code=None):
+    # A move post, still in flight unless it has a status
+    future = Future()
+    if status_code is not None:
+        future.set_result(SimpleNamespace(status_code=status_code))
+    return future
+
+
+def play(client, moves):
+    client.sync_moves(moves)
+    assert client.moves_text == moves
+
+
+def test_new_moves_are_applied_incrementally(client):
+    play(client, 'e2e4 e7e5')
+    board = client.board
+    applied = client.sync_moves('e2e4 e7e5 g1f3 d7d5')
+    assert applied == [('g1f3', None), ('d7d5', None)]
+    assert client.board is board
+    assert [move.uci() for move in client.board.move_stack] == ['e2e4', 'e7e5', 'g1f3', 'd7d5']
+
+
+def test_captures_are_reported(client):
+    play(client, 'e2e4 d7d5')
+    assert client.sync_moves('e2e4 d7d5 e4d5') == [('e4d5', 'pawn')]
+
+
+def test_echo_of_our_move_clears_pending(client):
+    play(client, 'e2e4 e7e5')
+    client.push_bot_move('g1f3')
+    client.pending_move = ('g1f3', posted(200))
+    assert client.sync_moves('e2e4 e7e5 g1f3') == []
+    assert client.pending_move is None
+    assert client.board.ply() == 3
+
+
+def test_stale_event_keeps_the_move_in_flight(client):
+    play(client, 'e2e4 e7e5')
+    client.push_bot_move('g1f3')
+    client.pending_move = ('g1f3', posted())
+    # An event sent before the server saw our move
+    assert client.sync_moves('e2e4 e7e5') == []
+    assert client.board.ply() == 3
+    assert client.moves_text == 'e2e4 e7e5 g1f3'
+    assert client.pending_move is not None
+
+
+def test_rejected_move_is_taken_back(client):
+    play(client, 'e2e4 e7e5')
+    client.push_bot_move('g1f3')
+    client.pending_move = ('g1f3', posted(400))
+    assert client.move_rejected(client.pending_move[1])
+    assert client.sync_moves('e2e4 e7e5') == []
+    assert client.board.ply() == 2
+    assert client.moves_text == 'e2e4 e7e5'
+    assert client.pending_move is None
+
+
+def test_failed_post_is_taken_back(client):
+    play(client, 'e2e4 e7e5')
+    client.push_bot_move('g1f3')
+    future = Future()
+    future.set_exception(ConnectionError('reset'))
+    client.pending_move = ('g1f3', future)
+    client.sync_moves('e2e4 e7e5')
+    assert client.board.ply() == 2
+
+
+def test_takeback(client):
+    play(client, 'e2e4 e7e5 g1f3 b8c6')
+    assert client.sync_moves('e2e4 e7e5') == []
+    assert [move.uci() for move in client.board.move_stack] == ['e2e4', 'e7e5']
+
+
+def test_divergence_rebuilds_the_board(client):
+    play(client, 'e2e4 e7e5 g1f3')
+    board = client.board
+    applied = client.sync_moves('d2d4 d7d5')
+    assert client.board is not board
+    assert [uci for uci, _ in applied] == ['d2d4', 'd7d5']
+    assert [move.uci() for move in client.board.move_stack] == ['d2d4', 'd7d5']
+
+
+def test_no_move_when_it_is_not_our_turn(client):
+    client.compute_next_move = lambda *args, **kwargs: pytest.fail('not our move')
+    assert client.on_game_state({'moves': 'e2e4', 'wtime': 60000, 'btime': 60000, 'winc': 0, 'binc': 0}) is None
+    assert client.board.ply() == 1
+
+
+def test_game_state_passes_capture_and_deadline(client, clock):
+    calls = []
+
+    def compute(opp_move, captured=None, deadline=None):
+        calls.append((opp_move, captured, deadline))
+        return 'd8d5'
+    client.compute_next_move = compute
+    client.resume('test', 'black')
+    play(client, 'e2e4')
+    client.push_bot_move('d7d5')
+    state = {'moves': 'e2e4 d7d5 e4d5', 'wtime': 60000, 'btime': 60000, 'winc': 1000, 'binc': 1000}
+    assert client.on_game_state(state) == 'd8d5'
+    (opp_move, captured, deadline), = calls
+    assert (opp_move, captured) == ('e4d5', 'pawn')
+    assert deadline.remaining() == pytest.approx(1.8)
+    clock.advance(1.0)
+    assert deadline.remaining() == pytest.approx(0.8)
+
+
+def test_reconnect_on_our_turn_thinks_again(client, clock):
+    calls = []
+    client.compute_next_move = lambda opp_move, captured=None, deadline=None: calls.append(opp_move) or 'g1f3'
+    play(client, 'e2e4 e7e5')
+    # Same move list as before the drop, no new moves but the move is still ours
+    assert client.on_game_state({'moves': 'e2e4 e7e5', 'wtime': 60000, 'btime': 60000}) == 'g1f3'
+    assert calls == ['e7e5']
+
+
+def stored_moves(client):
+    return [record['move'] for record in client.store.positions()]
+
+
+def test_refused_move_is_dropped_from_the_store(client):
+    client.store.start_game('test', 'white', client.initial_fen)
+    play(client, 'e2e4 e7e5')
+    client.push_bot_move('g1f3')
+    client.pending_move = ('g1f3', posted(400))
+    client.sync_moves('e2e4 e7e5')
+    client.push_bot_move('b1c3')
+    client.sync_moves('e2e4 e7e5 b1c3')
+    assert stored_moves(client) == ['e2e4', 'e7e5', 'b1c3']
+
+
+def test_rebuild_keeps_the_plies_both_histories_share(client):
+    client.store.start_game('test', 'white', client.initial_fen)
+    play(client, 'e2e4 e7e5 g1f3')
+    client.sync_moves('e2e4 c7c5')
+    assert stored_moves(client) == ['e2e4', 'c7c5']
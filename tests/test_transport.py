@@ -0,0 +1,179 @@
+import asyncio
+import email.utils
+import threading
+import time
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+import requests
+
+import async_client
+import transport as transport_module
+from response_cache import ResponseCache
+from scheduler import Deadline, DeadlineExceeded
+from transport import SendQueue, Transport, parse_retry_after
+
+
+class RecordingTransport:
+    # Answers every request with a 200 and keeps its arguments, requests to a
+    # blocked URL wait until released
+    def __init__(self):
+        self.requests = []
+        self.blocked = set()
+        self.release = threading.Event()
+
+    def request(self, method, url, **kwargs):
+        if url in self.blocked:
+            self.release.wait(5)
+        self.requests.append((method, url, kwargs))
+        return SimpleNamespace(status_code=200, text='')
+
+
+def test_each_game_posts_its_moves_independently():
+    transport = RecordingTransport()
+    transport.blocked.add('/a/e2e4')
+    game_a, game_b = SendQueue(transport), SendQueue(transport)
+    waiting = game_a.submit('POST', '/a/e2e4')
+    assert game_b.submit('POST', '/b/d2d4').result(timeout=5).status_code == 200
+    assert not waiting.done()
+    transport.release.set()
+    assert waiting.result(timeout=5).status_code == 200
+    game_a.close()
+    game_b.close()
+
+
+def test_move_posts_carry_the_flag_deadline(client, clock):
+    transport = RecordingTransport()
+    client.send_queue = SendQueue(transport)
+    flag = client.scheduler.flag_deadline({'wtime': 5000, 'btime': 9000}, 'white')
+    assert flag.remaining() == pytest.approx(5.0)
+    assert client.scheduler.flag_deadline({'wtime': 5000}, 'black') is None
+    client.make_move('e2e4', flag).result(timeout=5)
+    client.send_queue.close()
+    (method, url, kwargs), = transport.requests
+    assert url.endswith('/api/bot/game/test/move/e2e4')
+    assert kwargs['deadline'] is flag
+
+
+class Scripted:
+    # Plays back responses (or raises exceptions) in order
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def next(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def reply(status, **headers):
+    return SimpleNamespace(status_code=status, status=status, headers=headers, close=lambda: None, release=lambda: None)
+
+
+@pytest.fixture
+def waits(monkeypatch, clock):
+    # Backoff sleeps move the simulated clock instead of blocking
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        clock.advance(seconds)
+    monkeypatch.setattr(transport_module.time, 'sleep', sleep)
+    return slept
+
+
+def scripted_transport(*outcomes):
+    transport = Transport(retries=3, backoff=0.5, max_backoff=60)
+    script = Scripted(*outcomes)
+    transport.session = lambda url: SimpleNamespace(request=lambda method, url, **kwargs: script.next())
+    transport.delay = lambda attempt: 0.5 * 2 ** attempt
+    return transport, script
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(reply(429, **{'Retry-After': '1.5'})) == 1.5
+    assert parse_retry_after(reply(429, **{'Retry-After': '-3'})) == 0
+    later = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert parse_retry_after(reply(429, **{'Retry-After': later})) == pytest.approx(30, abs=2)
+    assert parse_retry_after(reply(429, **{'x-ratelimit-reset-requests': '6m0s'})) == 360
+    assert parse_retry_after(reply(429, **{'x-ratelimit-reset-tokens': '20ms'})) == pytest.approx(0.02)
+    assert parse_retry_after(reply(429)) is None
+
+
+def test_retry_after_is_honoured_and_capped(waits):
+    transport, script = scripted_transport(reply(429, **{'Retry-After': '2'}),
+                                           reply(429, **{'x-ratelimit-reset-requests': '6m0s'}), reply(200))
+    assert transport.request('POST', 'http://gpt/v1').status_code == 200
+    assert waits == [2, 60]
+
+
+def test_server_errors_back_off_until_attempts_run_out(waits):
+    transport, script = scripted_transport(*[reply(503)] * 4)
+    assert transport.request('GET', 'http://lichess/').status_code == 503
+    assert script.calls == 4
+    assert waits == [0.5, 1.0, 2.0]
+
+
+def test_client_errors_are_not_retried(waits):
+    transport, script = scripted_transport(reply(400), reply(200))
+    assert transport.request('POST', 'http://lichess/move').status_code == 400
+    assert waits == []
+
+
+def test_no_wait_past_the_deadline(waits, clock):
+    transport, script = scripted_transport(reply(429, **{'Retry-After': '5'}), reply(200))
+    assert transport.request('POST', 'http://gpt/v1', deadline=Deadline(3, clock)).status_code == 429
+    assert waits == []
+
+
+def test_connection_errors(waits, clock):
+    transport, script = scripted_transport(requests.ConnectionError('reset'), reply(200))
+    assert transport.request('GET', 'http://lichess/').status_code == 200
+    assert waits == [0.5]
+
+    transport, script = scripted_transport(*[requests.ConnectionError('reset')] * 4)
+    with pytest.raises(requests.ConnectionError):
+        transport.request('GET', 'http://lichess/')
+    assert script.calls == 4
+
+    transport, script = scripted_transport(requests.ConnectionError('reset'), reply(200))
+    with pytest.raises(DeadlineExceeded):
+        transport.request('GET', 'http://lichess/', deadline=Deadline(0.2, clock))
+
+
+def run_async(clock, monkeypatch, *outcomes, deadline=None):
+    # AsyncChessEngine.request against a scripted session, sleeping on the simulated clock
+    slept = []
+
+    async def sleep(seconds):
+        slept.append(seconds)
+        clock.advance(seconds)
+    monkeypatch.setattr(async_client.asyncio, 'sleep', sleep)
+    monkeypatch.setattr(transport_module.transport, 'delay', lambda attempt: 0.5 * 2 ** attempt)
+    script = Scripted(*outcomes)
+
+    async def request(method, url, **kwargs):
+        return script.next()
+    engine = async_client.AsyncChessEngine(cache=ResponseCache(path=None))
+    engine.session = SimpleNamespace(request=request)
+    try:
+        resp = asyncio.run(engine.request('POST', 'http://gpt/v1', deadline))
+    finally:
+        engine.executor.shutdown()
+    return resp, slept
+
+
+def test_async_engine_retries_the_same_way(monkeypatch, tmp_path, clock):
+    monkeypatch.chdir(tmp_path)
+    resp, slept = run_async(clock, monkeypatch, reply(429, **{'Retry-After': '2'}), reply(200))
+    assert (resp.status, slept) == (200, [2])
+    resp, slept = run_async(clock, monkeypatch, aiohttp.ClientConnectionError('reset'), reply(503), reply(200))
+    assert (resp.status, slept) == (200, [0.5, 1.0])
+    resp, slept = run_async(clock, monkeypatch, reply(429, **{'Retry-After': '5'}), reply(200), deadline=Deadline(3, clock))
+    assert (resp.status, slept) == (429, [])
+    with pytest.raises(DeadlineExceeded):
+        run_async(clock, monkeypatch, aiohttp.ClientConnectionError('reset'), reply(200), deadline=Deadline(0.2, clock))
@@ -0,0 +1,182 @@
+import email.utils
+import queue
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import log
+from scheduler import DeadlineExceeded
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+DURATION_PART = re.compile(r'([\d.]+)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_retry_after(resp):
+    # Retry-After is seconds or an HTTP date, OpenAI also sends resets like '6m0s' or '20ms'
+    value = resp.headers.get('Retry-After')
+    if value:
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            date = email.utils.parsedate_to_datetime(value)
+            if date is not None:
+                return max(date.timestamp() - time.time(), 0)
+    for header in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+        value = resp.headers.get(header)
+        if value:
+            parts = DURATION_PART.findall(value)
+            if parts:
+                return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+    return None
+
+
+class Transport:
+    def __init__(self, timeout=(5, 120), retries=4, backoff=0.5, max_backoff=60, pool_size=16):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        # One keep-alive pool per host so Lichess and OpenAI connections are reused independently
+        host = urlsplit(url).netloc
+        with self.lock:
+            s = self.sessions.get(host)
+            if s is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                self.sessions[host] = s
+            return s
+
+    def delay(self, attempt):
+        # Full jitter so concurrent games don't retry in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def clamp(self, timeout, deadline):
+        # Neither connecting nor waiting for the response may outlive the move budget
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded('no time left to send the request')
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        return min(connect, remaining), min(read, remaining)
+
+    def retry_wait(self, attempt, resp=None, deadline=None):
+        # Seconds to wait before the next attempt, None when there is none: out
+        # of attempts, or the wait would outlast the deadline. resp is the
+        # refused response, None after a connection error. Shared with the
+        # async engine so both retry the same way.
+        if attempt >= self.retries:
+            return None
+        wait = parse_retry_after(resp) if resp is not None else None
+        if wait is None:
+            wait = self.delay(attempt)
+        wait = min(wait, self.max_backoff)
+        if deadline is not None and wait >= deadline.remaining():
+            return None
+        return wait
+
+    def request(self, method, url, timeout=None, deadline=None, **kwargs):
+        s = self.session(url)
+        for attempt in range(self.retries + 1):
+            request_timeout = timeout or self.timeout
+            if deadline is not None:
+                request_timeout = self.clamp(request_timeout, deadline)
+            try:
+                resp = s.request(method, url, timeout=request_timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded(f'{method} {url} cut off by the move budget') from e
+                wait = self.retry_wait(attempt, deadline=deadline)
+                if wait is None:
+                    if attempt == self.retries:
+                        raise
+                    raise DeadlineExceeded(f'{method} {url} failed with no time left to retry') from e
+                log.warning('%s %s failed (%r), retrying in %.1fs', method, url, e, wait)
+                time.sleep(wait)
+                continue
+
+            if resp.status_code not in RETRY_STATUSES:
+                return resp
+            wait = self.retry_wait(attempt, resp, deadline)
+            if wait is None:
+                # Out of attempts, or waiting would only flag us: hand back the error response
+                return resp
+            log.warning('%s %s returned %d, retrying in %.1fs', method, url, resp.status_code, wait)
+            resp.close()
+            time.sleep(wait)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for s in self.sessions.values():
+                s.close()
+            self.sessions = {}
+
+
+class SendQueue:
+    # Fire-and-forget posts (moves, chat) of one game go out in order from a
+    # background thread, each send retried by the transport. Every game has its
+    # own, so a move waiting out a Retry-After does not hold up other games.
+    def __init__(self, transport):
+        self.transport = transport
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, method, url, **kwargs):
+        future = Future()
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='send-queue', daemon=True)
+                self.thread.start()
+        self.queue.put((future, method, url, kwargs))
+        return future
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            future, method, url, kwargs = item
+            try:
+                resp = self.transport.request(method, url, **kwargs)
+                if resp.status_code >= 400:
+                    log.error('%s %s failed with %d: %s', method, url, resp.status_code, resp.text)
+                future.set_result(resp)
+            except Exception as e:
+                log.error('%s %s failed: %r', method, url, e)
+                future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                self.queue.put(None)
+                self.thread.join()
+            self.thread = None
+
+
+transport = Transport()